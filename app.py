@@ -1,15 +1,45 @@
 #! venv/bin/python
 
-from flask import Flask, request, jsonify, make_response
+from flask import Flask, request, jsonify, make_response, abort, Response, g
 import json
-import traceback
+import logging
+import time
+import uuid
 
-from log import log
+from config import config
+from connections import pools
+from resilience import resilience
+from log import log, request_id
 from incidents_manager import IncidentsManager
+from incident import IncidentState, IncidentPriority
+from jobs import JobQueue
+from dedup import DedupStore
+import incident_index
+import metrics
 
 app = Flask(__name__)
 
 incidents = IncidentsManager()
+# Backends are connected in the background, /ready tells when it's done
+if config.get('warmup', True):
+    incidents.start_warmup()
+
+# Asynchronous mode: acknowledge the webhook right away and let workers run
+# the side effects (Jira, ES, Slack, Cachet)
+webhook_config = config.get('webhook', {})
+jobs = None
+if webhook_config.get('async', False):
+    jobs = JobQueue(workers=webhook_config.get('workers', 4),
+                    history=webhook_config.get('jobs_history', 1000))
+    jobs.start()
+
+# Dialogflow retries requests on timeout: answer retries with the result of
+# the first request instead of handling them again
+dedup_config = config.get('dedup', {})
+dedup = None
+if dedup_config.get('enabled', True):
+    dedup = DedupStore(size=dedup_config.get('size', 10000),
+                       path=dedup_config.get('path'))
 
 
 # Error Handlers
@@ -39,23 +69,249 @@ def index():
     return "Hello, I'm incidents bot!"
 
 
+@app.route('/ready')
+def ready():
+    """Readiness of each backend, 503 until all of them are ready"""
+    status = incidents.readiness()
+    ready_states = ('ready', 'disabled')
+    if not config.get('warmup', True):
+        # Backends are only connected once used: pending is fine
+        ready_states += ('pending',)
+    all_ready = all(backend['state'] in ready_states
+                    for backend in status.values())
+    return make_response(jsonify(status), 200 if all_ready else 503)
+
+
+@app.route('/jobs')
+def list_jobs():
+    """Queue depth and job counts by state"""
+    if jobs is None:
+        abort(404)
+    return jsonify(jobs.stats())
+
+
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    """Status of a single job"""
+    job = jobs and jobs.get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job.to_dict())
+
+
+@app.route('/caches')
+def caches_stats():
+    """Hits, misses and evictions of the Slack caches"""
+    return jsonify({
+        cache.name: cache.stats()
+        for cache in (incidents.slack_channels_cache,
+                      incidents.slack_users_cache)
+    })
+
+
+@app.route('/connections')
+def connections_stats():
+    """Connection pools usage, per backend"""
+    return jsonify(pools.stats())
+
+
+@app.route('/resilience')
+def resilience_stats():
+    """Circuit breaker and bulkhead state, per backend"""
+    return jsonify(resilience.stats())
+
+
+@app.route('/outbox')
+def outbox_stats():
+    """Pending and dead side effects, and circuit state, per backend"""
+    return jsonify(incidents.outbox.stats())
+
+
+@app.route('/incidents')
+def list_incidents():
+    """
+    Incidents, most recently opened first, from the local incidents index
+
+    Filters: `state`, `priority`, `opened_after`, `opened_before`,
+    `closed_after`, `closed_before` (ISO dates). Pages have `limit` incidents,
+    the next one is read with the `cursor` of the previous one.
+    """
+    args = request.args
+    try:
+        filters = {
+            'state': parse_enum(IncidentState, args.get('state')),
+            'priority': parse_enum(IncidentPriority, args.get('priority')),
+            'limit': int(args.get('limit', incident_index.DEFAULT_LIMIT)),
+            'cursor': args.get('cursor')
+        }
+        for name in ('opened_after', 'opened_before', 'closed_after',
+                     'closed_before'):
+            if args.get(name):
+                filters[name] = incident_index.parse_date(args[name])
+        found, cursor = incidents.index.query(**filters)
+    except ValueError as e:
+        abort(400, str(e))
+    return jsonify({'incidents': [summary.to_dict() for summary in found],
+                    'cursor': cursor})
+
+
+@app.route('/incidents/stats')
+def incidents_stats():
+    """Open and closed incidents, and mean time to resolve, by priority"""
+    return jsonify(incidents.index.stats())
+
+
+@app.route('/incidents/<int:incident_id>')
+def get_incident(incident_id):
+    summary = incidents.index.get(incident_id)
+    if summary is None:
+        abort(404)
+    return jsonify(summary.to_dict())
+
+
+def parse_enum(enum, value):
+    """Enum member from its value, case insensitive"""
+    if not value:
+        return None
+    for member in enum:
+        if member.value.lower() == value.lower():
+            return member
+    raise ValueError("Invalid " + enum.__name__ + " " + value)
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus metrics"""
+    return Response(metrics.registry.render(),
+                    mimetype='text/plain; version=0.0.4')
+
+
+metrics.registry.register(metrics.Gauge(
+    'incidents_connections_in_flight',
+    "Requests in flight, per backend connection pool",
+    ('backend',),
+    lambda: {(backend, ): stats['in_flight']
+             for backend, stats in pools.stats().items()}))
+metrics.registry.register(metrics.Gauge(
+    'incidents_circuit_open',
+    "Whether calls to a backend are cut off by its circuit breaker",
+    ('backend',),
+    lambda: {(backend, ): int(stats['circuit']['state'] != 'closed')
+             for backend, stats in resilience.stats().items()}))
+metrics.registry.register(metrics.Gauge(
+    'incidents_outbox_pending',
+    "Side effects waiting in the outbox, per backend",
+    ('backend',),
+    lambda: {(backend, ): stats['pending']
+             for backend, stats in incidents.outbox.stats().items()}))
+metrics.registry.register(metrics.Gauge(
+    'incidents_open',
+    "Ongoing incidents, per priority",
+    ('priority',),
+    lambda: {(priority, ): stats['open'] for priority, stats in
+             incidents.index.stats()['by_priority'].items()}))
+metrics.registry.register(metrics.Gauge(
+    'incidents_jobs_queue_depth',
+    "Intents waiting for a worker",
+    (),
+    lambda: {(): jobs.depth()} if jobs is not None else {}))
+
+
+# Intents
+
+
+def create_incident(parameters, event):
+    incidents.create_incident(
+        priority=parameters['color'],
+        title=parameters['title'],
+        description=parameters['description'])
+
+
+def close_incident(parameters, event):
+    incidents.close_incident(event)
+
+
+def log_update(parameters, event):
+    incidents.log_update(parameters, event)
+
+
+def list_incident_updates(parameters, event):
+    incidents.list_incident_updates(parameters, event)
+
+
+def set_incident_description(parameters, event):
+    incidents.set_incident_description(parameters, event)
+
+
+def run_intent(intent, handler, parameters, event):
+    """Run an intent handler, recording how long it took"""
+    start = time.perf_counter()
+    outcome = 'error'
+    try:
+        handler(parameters, event)
+        outcome = 'success'
+    finally:
+        metrics.intent_latency.observe(time.perf_counter() - start,
+                                       intent, outcome)
+
+
+intents_handlers = {
+    "incident.create": create_incident,
+    "incident.close": close_incident,
+    "incident.update": log_update,
+    "incident.list_updates": list_incident_updates,
+    "incident.set_description": set_incident_description,
+}
+
+# Intents on the incident of the channel they come from
+incident_intents = {
+    "incident.close",
+    "incident.update",
+    "incident.list_updates",
+    "incident.set_description",
+}
+
+
 @app.route('/webhook', methods=['POST'])
 def webhook():
     """
     Main webhook
     """
+    start = time.perf_counter()
+    # Every log of this request, including from the threads working on it,
+    # carries its ID: Dialogflow's, unless the caller gave one
+    req = request.get_json(silent=True, force=True) or {}
+    rid = request.headers.get('X-Request-ID') or req.get('responseId') or \
+        uuid.uuid4().hex
+    token = request_id.set(rid)
+    try:
+        response = handle_webhook()
+        response.headers['X-Request-ID'] = rid
+        return response
+    finally:
+        request_id.reset(token)
+        # Only known intents get their own series
+        intent = g.get('intent')
+        if intent not in intents_handlers:
+            intent = 'unknown'
+        metrics.webhook_latency.observe(time.perf_counter() - start, intent)
+
+
+def handle_webhook():
     req = request.get_json(silent=True, force=True)
-    log.info("Handling new request:\n" + json.dumps(req, indent=4))
+    log.info("Handling new request")
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Request:\n%s", json.dumps(req, indent=4))
 
     # Parsing intent
     # noinspection PyBroadException
     try:
         log.info("Parsing intent...")
         intent = req['queryResult']['intent']['displayName']
-        log.info("Got a new intent: " + intent)
+        log.info("Got a new intent: %s", intent)
+        g.intent = intent
     except Exception:
-        traceback.print_exc()
-        log.error("Failed to parse intent")
+        log.exception("Failed to parse intent")
         return jsonify({"status": "failed"})
 
     # Dispatching based on parsed intent
@@ -69,25 +325,45 @@ def webhook():
         log.info("Skipping intent, sent by the bot itself")
         return jsonify({"status": "success"})
 
-    log.info("Dispatching based on intent ...")
-    if intent == "incident.create":
-        incidents.create_incident(
-            priority=parameters['color'],
-            title=parameters['title'],
-            description=parameters['description'])
-    elif intent == "incident.close":
-        incidents.close_incident(event)
-    elif intent == "incident.update":
-        incidents.log_update(parameters, event)
-    elif intent == "incident.list_updates":
-        incidents.list_incident_updates(event)
-    elif intent == "incident.set_description":
-        incidents.set_incident_description(parameters, event)
+    if dedup is None:
+        return jsonify(dispatch(intent, parameters, event))
+    return jsonify(dedup.run(request_keys(req, event),
+                             lambda: dispatch(intent, parameters, event)))
+
+
+def request_keys(req, event):
+    """Keys identifying a request, and its retries"""
+    if event.get('client_msg_id'):
+        message_key = "slack:" + event['client_msg_id']
+    elif event.get('ts'):
+        message_key = "slack:" + event.get('channel', '') + ":" + event['ts']
     else:
-        log.warning("Couldn't dispatch intent {intent} to anything "
-                    "known".format(intent=intent))
-        return jsonify({"status": "failed"})
-    return jsonify({"status": "success"})
+        message_key = None
+    response_id = req.get('responseId')
+    return [response_id and "dialogflow:" + response_id, message_key]
+
+
+def dispatch(intent, parameters, event):
+    log.info("Dispatching based on intent ...")
+    handler = intents_handlers.get(intent)
+    if handler is None:
+        log.warning("Couldn't dispatch intent %s to anything known",
+                    intent)
+        return {"status": "failed"}
+    if jobs is not None:
+        # Commands on an existing incident run in order, one at a time
+        channel_id = event.get('channel') if intent in incident_intents \
+            else None
+        if channel_id:
+            job = jobs.submit_in_order(channel_id, intent, run_intent, intent,
+                                       handler, parameters, event)
+        else:
+            job = jobs.submit(intent, run_intent, intent, handler, parameters,
+                              event)
+        log.info("Queued intent %s as job %s", intent, job.id)
+        return {"status": "success", "job": job.id}
+    run_intent(intent, handler, parameters, event)
+    return {"status": "success"}
 
 if __name__ == '__main__':
     app.run(debug=True, port=5000, host='0.0.0.0')
@@ -0,0 +1,58 @@
+from enum import Enum
+import threading
+
+from log import log
+
+
+class BackendState(Enum):
+    PENDING     = "pending"
+    READY       = "ready"
+    FAILED      = "failed"
+    # Not loaded ahead of time, see the `warmup` setting
+    DISABLED    = "disabled"
+
+
+class Backend(object):
+    """
+    Client of a backend, connected on first use
+
+    A failed connection is retried on the next use, so a backend that was
+    slow or down at startup doesn't need a restart once it's back.
+    """
+    def __init__(self, name, connect):
+        self.name       = name
+        self.connect    = connect
+        self.client     = None
+        self.state      = BackendState.PENDING
+        self.error      = None
+        self.lock       = threading.Lock()
+
+    def get(self):
+        client = self.client
+        if client is not None:
+            return client
+        with self.lock:
+            if self.client is None:
+                log.info("Connecting to %s ...", self.name)
+                try:
+                    self.client = self.connect()
+                except Exception as e:
+                    self.state = BackendState.FAILED
+                    self.error = str(e)
+                    log.error("Couldn't connect to %s", self.name)
+                    raise
+                self.state = BackendState.READY
+                self.error = None
+                log.info("... connected to %s", self.name)
+            return self.client
+
+    def warmup(self):
+        """Connect now, without raising"""
+        # noinspection PyBroadException
+        try:
+            self.get()
+        except Exception:
+            log.exception("Warmup of %s failed", self.name)
+
+    def status(self):
+        return {'state': self.state.value, 'error': self.error}
@@ -0,0 +1,61 @@
+import threading
+
+from log import log
+
+
+class Batch(object):
+    def __init__(self):
+        self.items      = []
+        self.results    = None
+        self.full       = threading.Event()
+        self.done       = threading.Event()
+
+
+class Batcher(object):
+    """
+    Group the items submitted within `window` seconds, up to `max_size`
+    of them, into a single `run_batch(items)` call
+
+    The first caller of a batch waits for the window to end, or for the
+    batch to be full, then runs it; the others wait for it. `run_batch`
+    returns a result for each item, in order: each caller gets its own, or
+    has it raised if it is an exception.
+    """
+    def __init__(self, name, run_batch, window=2.0, max_size=20):
+        self.name       = name
+        self.run_batch  = run_batch
+        self.window     = window
+        self.max_size   = max_size
+        self.current    = None
+        self.lock       = threading.Lock()
+
+    def submit(self, item):
+        with self.lock:
+            batch = self.current
+            leader = batch is None
+            if leader:
+                batch = self.current = Batch()
+            idx = len(batch.items)
+            batch.items.append(item)
+            if len(batch.items) >= self.max_size:
+                self.current = None
+                batch.full.set()
+        if leader:
+            batch.full.wait(self.window)
+            with self.lock:
+                if self.current is batch:
+                    self.current = None
+            log.info("Running %s batch of %s", self.name, len(batch.items))
+            try:
+                batch.results = self.run_batch(batch.items)
+            except Exception as e:
+                batch.results = [e] * len(batch.items)
+            finally:
+                batch.done.set()
+        else:
+            log.debug("Joined %s batch, waiting for it", self.name)
+            batch.done.wait()
+        result = batch.results[idx]
+        if isinstance(result, Exception):
+            raise result
+        return result
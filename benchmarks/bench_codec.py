@@ -0,0 +1,92 @@
+"""
+Micro-benchmark of the Incident codec against the previous one
+
+The previous codec dumped `__dict__` with an indented, `default()`-based
+JSON encoder and parsed every date with `strptime`.
+
+Run from the repository root (it needs a config.json):
+
+    python benchmarks/bench_codec.py [updates count]
+"""
+from datetime import datetime
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from incident import Incident, IncidentPriority, IncidentState, Update  # noqa
+
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+class LegacyEncoder(json.JSONEncoder):
+    def default(self, o):
+        if isinstance(o, datetime):
+            return o.strftime('%Y-%m-%dT%H:%M:%S%z')
+        if isinstance(o, IncidentState) or isinstance(o, IncidentPriority):
+            return o.value
+        if isinstance(o, Update):
+            return {'message': o.message, 'author': o.author, 'date': o.date}
+        return o.__str__()
+
+
+def legacy_serialize(incident):
+    source = {name: getattr(incident, name) for name in Incident.SCHEMA.names}
+    return json.dumps(source, indent=4, cls=LegacyEncoder, ensure_ascii=False)
+
+
+def legacy_unserialize(source):
+    source['opening_time'] = datetime.strptime(source['opening_time'],
+                                               DATE_FORMAT)
+    source['starting_time'] = datetime.strptime(source['starting_time'],
+                                                DATE_FORMAT)
+    source['priority'] = IncidentPriority(source['priority'])
+    source['state'] = IncidentState(source['state'])
+    for update in source['updates']:
+        update['date'] = datetime.strptime(update['date'], DATE_FORMAT)
+    return source
+
+
+def make_incident(updates_count):
+    incident = Incident(1234, priority="red", title="Benchmark",
+                        description="Incident with a long history")
+    author = {'id': 'U84T2CA6R', 'name': 'someone', 'real_name': 'Someone'}
+    for idx in range(updates_count):
+        incident.updates.append(Update("Update number " + str(idx), author,
+                                       datetime.now()))
+    return incident
+
+
+def bench(name, func, number):
+    seconds = min(timeit.repeat(func, number=number, repeat=5)) / number
+    print("{:<24} {:>10.1f} us".format(name, seconds * 1e6))
+    return seconds
+
+
+def main():
+    updates_count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    number = max(1, 20000 // (updates_count + 1))
+    incident = make_incident(updates_count)
+    legacy_json = legacy_serialize(incident)
+    compact_json = incident.serialize()
+    print("Incident with {} updates: {} bytes (legacy) vs {} bytes".format(
+        updates_count, len(legacy_json), len(compact_json)))
+
+    legacy_encode = bench("legacy encode",
+                          lambda: legacy_serialize(incident), number)
+    encode = bench("encode", incident.serialize, number)
+    legacy_decode = bench("legacy decode",
+                          lambda: legacy_unserialize(json.loads(legacy_json)),
+                          number)
+    decode = bench("decode",
+                   lambda: Incident.SCHEMA.from_dict(
+                       Incident.__new__(Incident), json.loads(compact_json)),
+                   number)
+    print("encode speedup: {:.1f}x, decode speedup: {:.1f}x".format(
+        legacy_encode / encode, legacy_decode / decode))
+
+
+if __name__ == '__main__':
+    main()
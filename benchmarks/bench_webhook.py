@@ -0,0 +1,321 @@
+"""
+Load test of /webhook, replaying the tests/sample_*.json payloads against
+in-process fake backends (`fakes.py`)
+
+Each virtual incident is created, gets updates, a new description, is listed
+and closed, with requests derived from the samples. `--concurrency`
+incidents are handled at a time. Every backend call sleeps for its
+`--latency` and fails with its `--error-rate`, given in milliseconds and
+ratios, for all backends or as `backend=value`:
+
+    python benchmarks/bench_webhook.py --incidents 50 --concurrency 8 \\
+        --latency 20 --latency jira=150 --error-rate cachet=0.05
+
+With `--batch-window`, creates arriving within that many seconds are
+batched (`incident_batching`); `--concurrency` sets how many arrive at once.
+
+Throughput and p50/p99 latencies are reported for each intent, and the
+number of calls made to each backend. They can be
+saved with `--save-baseline FILE`, and checked against a saved baseline with
+`--baseline FILE`: the run then exits with an error if an intent got slower
+or less successful than `--tolerance` allows.
+
+It doesn't need any backend nor config.json: the app runs with its own
+configuration, from a temporary directory.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from copy import deepcopy
+import argparse
+import json
+import logging
+import math
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+BACKENDS = ('slack', 'jira', 'elasticsearch', 'cachet')
+
+BENCH_CONFIG = {
+    "slack": {
+        "channel": "#incidents",
+        "self": {"token": "xoxb-bench", "id": "UBOT", "name": "incidents-bot"},
+        "fake_user": {"token": "xoxp-bench"},
+        "apiai_user": {"id": "UAPIAI"}
+    },
+    "elasticsearch": {"index": "incidents", "host": "localhost",
+                      "region": "local"},
+    "jira": {"host": "https://jira.example.org", "user": "bench",
+             "password": "bench", "project": "INC"},
+    "cachet": {"host": "http://cachet.example.org/api/v1", "token": "bench",
+               "debounce": 0.2},
+    "warmup": False,
+    "dedup": {"enabled": True, "size": 100000}
+}
+
+INTENTS = ('incident.create', 'incident.update', 'incident.set_description',
+           'incident.list_updates', 'incident.close')
+
+
+def parse_by_backend(values, scale=1.0):
+    """["20", "jira=150"] -> {backend: value * scale}"""
+    by_backend = {}
+    for value in values:
+        if '=' in value:
+            backend, value = value.split('=', 1)
+            if backend not in BACKENDS:
+                raise argparse.ArgumentTypeError("Unknown backend " + backend)
+            by_backend[backend] = float(value) * scale
+        else:
+            by_backend.update({backend: float(value) * scale
+                               for backend in BACKENDS
+                               if backend not in by_backend})
+    return by_backend
+
+
+def load_sample(name):
+    with open(os.path.join(ROOT, 'tests', 'sample_' + name + '.json')) as f:
+        return json.load(f)
+
+
+class Payloads(object):
+    """Synthetic variants of the samples, each one a distinct request"""
+    def __init__(self):
+        self.create = load_sample('create')
+        self.close  = load_sample('close')
+        self.list   = load_sample('list')
+
+    @staticmethod
+    def variant(sample, intent, parameters, channel_id):
+        payload = deepcopy(sample)
+        payload['responseId'] = str(uuid.uuid4())
+        payload['queryResult']['intent']['displayName'] = intent
+        payload['queryResult']['parameters'] = parameters
+        event = payload['originalDetectIntentRequest']['payload']['data'][
+            'event']
+        event['ts'] = event['event_ts'] = "{:.6f}".format(time.time())
+        if channel_id is not None:
+            event['channel'] = channel_id
+        return payload
+
+    def for_intent(self, intent, parameters, channel_id=None):
+        sample = {'incident.create': self.create,
+                  'incident.list_updates': self.list}.get(intent, self.close)
+        return self.variant(sample, intent, parameters, channel_id)
+
+
+class Recorder(object):
+    """Latencies and errors, by intent"""
+    def __init__(self):
+        self.lock       = threading.Lock()
+        self.latencies  = {intent: [] for intent in INTENTS}
+        self.errors     = {intent: 0 for intent in INTENTS}
+
+    def record(self, intent, seconds, ok):
+        with self.lock:
+            self.latencies[intent].append(seconds)
+            if not ok:
+                self.errors[intent] += 1
+
+
+def percentile(values, ratio):
+    """Nearest-rank percentile"""
+    values = sorted(values)
+    return values[max(0, int(math.ceil(ratio * len(values))) - 1)]
+
+
+class Scenario(object):
+    def __init__(self, client, fakes, payloads, recorder, updates):
+        self.client     = client
+        self.fakes      = fakes
+        self.payloads   = payloads
+        self.recorder   = recorder
+        self.updates    = updates
+
+    def post(self, intent, parameters, channel_id=None):
+        payload = self.payloads.for_intent(intent, parameters, channel_id)
+        start = time.perf_counter()
+        response = self.client.post('/webhook', data=json.dumps(payload),
+                                    content_type='application/json')
+        seconds = time.perf_counter() - start
+        ok = (response.status_code == 200 and
+              json.loads(response.get_data(as_text=True)).get('status') ==
+              'success')
+        self.recorder.record(intent, seconds, ok)
+        return ok
+
+    def run(self, idx):
+        title = "Benchmark incident " + str(idx)
+        if not self.post('incident.create', {
+                'color': ('red', 'orange')[idx % 2],
+                'title': title,
+                'description': "Replayed from sample_create.json"}):
+            return
+        # The incident channel gets the title as topic
+        channel_id = self.fakes.slack.channel_of_topic(title)
+        if channel_id is None:
+            return
+        for update_idx in range(self.updates):
+            self.post('incident.update', {
+                'description': "Update " + str(update_idx) + " of " + title
+            }, channel_id)
+        self.post('incident.set_description',
+                  {'description': "New description of " + title}, channel_id)
+        self.post('incident.list_updates', {}, channel_id)
+        self.post('incident.close', {}, channel_id)
+
+
+def setup_app(args):
+    """Import the app with the benchmark configuration and fake backends"""
+    workdir = tempfile.mkdtemp(prefix='bench-webhook-')
+    with open(os.path.join(workdir, 'config.json'), 'w') as config_file:
+        json.dump(BENCH_CONFIG, config_file)
+    os.chdir(workdir)
+    import app
+    from fakes import FakeBackends, Faults
+    if not args.verbose:
+        logging.getLogger('incidents-bot').setLevel(logging.WARNING)
+        # Failed requests are counted, not logged
+        app.app.logger.setLevel(logging.CRITICAL)
+    faults = Faults(latency=parse_by_backend(args.latency, scale=0.001),
+                    error_rate=parse_by_backend(args.error_rate),
+                    seed=args.seed)
+    fakes = FakeBackends(faults, BENCH_CONFIG['jira']['project'])
+    fakes.install(app.incidents)
+    return app, fakes
+
+
+def run(args):
+    if args.batch_window:
+        BENCH_CONFIG['incident_batching'] = {'window': args.batch_window}
+    app, fakes = setup_app(args)
+    recorder = Recorder()
+    scenario = Scenario(app.app.test_client(), fakes, Payloads(), recorder,
+                        args.updates)
+    output = sys.stdout if args.verbose else open(os.devnull, 'w')
+    start = time.perf_counter()
+    with redirect_stdout(output), \
+            ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(scenario.run, range(args.incidents)))
+    wall = time.perf_counter() - start
+    app.incidents.es_writer.flush()
+    return results(recorder, wall, fakes.faults.calls)
+
+
+def results(recorder, wall, calls):
+    intents = {}
+    for intent in INTENTS:
+        latencies = recorder.latencies[intent]
+        if not latencies:
+            continue
+        intents[intent] = {
+            'count': len(latencies),
+            'errors': recorder.errors[intent],
+            'throughput': len(latencies) / wall,
+            'p50': percentile(latencies, 0.50),
+            'p99': percentile(latencies, 0.99)
+        }
+    calls_by_backend = {}
+    for (backend, _), count in calls.items():
+        calls_by_backend[backend] = calls_by_backend.get(backend, 0) + count
+    return {'wall': wall, 'intents': intents, 'calls': calls_by_backend}
+
+
+def report(params, res):
+    print("{incidents} incidents, {updates} updates each, concurrency "
+          "{concurrency}: {wall:.2f}s".format(wall=res['wall'], **params))
+    print("{:<26} {:>6} {:>6} {:>9} {:>9} {:>9}".format(
+        "intent", "count", "errors", "req/s", "p50 ms", "p99 ms"))
+    for intent, stats in res['intents'].items():
+        print("{:<26} {:>6} {:>6} {:>9.1f} {:>9.1f} {:>9.1f}".format(
+            intent, stats['count'], stats['errors'], stats['throughput'],
+            stats['p50'] * 1000, stats['p99'] * 1000))
+    print("backend calls: " + ", ".join(
+        "{} {}".format(backend, count)
+        for backend, count in sorted(res['calls'].items())))
+
+
+def compare(baseline, params, res, tolerance):
+    """Regressions against a baseline, as messages"""
+    if baseline['params'] != params:
+        print("Warning: baseline was run with " +
+              json.dumps(baseline['params'], sort_keys=True))
+    regressions = []
+    for intent, base in baseline['intents'].items():
+        stats = res['intents'].get(intent)
+        if stats is None:
+            regressions.append(intent + ": not run")
+            continue
+        for key in ('p50', 'p99'):
+            if stats[key] > base[key] * (1 + tolerance):
+                regressions.append("{}: {} {:.1f}ms > {:.1f}ms".format(
+                    intent, key, stats[key] * 1000, base[key] * 1000))
+        if stats['throughput'] < base['throughput'] * (1 - tolerance):
+            regressions.append("{}: {:.1f} req/s < {:.1f} req/s".format(
+                intent, stats['throughput'], base['throughput']))
+        if stats['errors'] > base['errors']:
+            regressions.append("{}: {} errors > {}".format(
+                intent, stats['errors'], base['errors']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay webhook payloads against fake backends")
+    parser.add_argument('--incidents', type=int, default=20)
+    parser.add_argument('--updates', type=int, default=5,
+                        help="updates posted on each incident")
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--latency', action='append', default=[],
+                        help="backend latency in ms, [backend=]ms")
+    parser.add_argument('--error-rate', action='append', default=[],
+                        help="backend error rate, [backend=]ratio")
+    parser.add_argument('--batch-window', type=float, default=0,
+                        help="incidents creation batching window, seconds")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', help="baseline to check against")
+    parser.add_argument('--save-baseline', help="where to save the results")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="allowed regression ratio (default: 0.2)")
+    parser.add_argument('--verbose', action='store_true',
+                        help="keep the app logs")
+    args = parser.parse_args()
+    args.latency = args.latency or ['10']
+    # The app runs from its own directory
+    for name in ('baseline', 'save_baseline'):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+
+    params = {'incidents': args.incidents, 'updates': args.updates,
+              'concurrency': args.concurrency,
+              'latency': sorted(args.latency),
+              'error_rate': sorted(args.error_rate), 'seed': args.seed,
+              'batch_window': args.batch_window}
+    res = run(args)
+    report(params, res)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({'params': params, 'intents': res['intents']}, f,
+                      indent=4, sort_keys=True)
+        print("Saved baseline to " + args.save_baseline)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, params, res, args.tolerance)
+        if regressions:
+            print("Regressions against " + args.baseline + ":")
+            for regression in regressions:
+                print("- " + regression)
+            sys.exit(1)
+        print("No regression against " + args.baseline)
+
+
+if __name__ == '__main__':
+    main()
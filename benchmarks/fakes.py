@@ -0,0 +1,316 @@
+"""
+In-process fakes of the Slack, Jira, Elasticsearch and Cachet clients
+
+They implement just what `IncidentsManager` and `Incident` call, keep their
+state in memory, and go through `Faults` on every call to simulate latency
+and errors.
+"""
+from copy import deepcopy
+import json
+import random
+import threading
+import time
+
+from elasticsearch import ConflictError, NotFoundError
+from elasticsearch.serializer import JSONSerializer
+from slacker import Error as SlackerError
+
+from backends import Backend
+
+
+class FakeBackendError(Exception):
+    pass
+
+
+class Faults(object):
+    """
+    Latency, in seconds, and error rate of each backend
+
+    Each call sleeps for its backend latency, +/- 50%, then fails with the
+    backend error rate.
+    """
+    def __init__(self, latency=None, error_rate=None, seed=None):
+        self.latency    = latency or {}
+        self.error_rate = error_rate or {}
+        self.random     = random.Random(seed)
+        self.lock       = threading.Lock()
+        self.calls      = {}
+
+    def call(self, backend, method):
+        with self.lock:
+            self.calls[(backend, method)] = \
+                self.calls.get((backend, method), 0) + 1
+            jitter = self.random.uniform(0.5, 1.5)
+            failed = self.random.random() < self.error_rate.get(backend, 0.0)
+        latency = self.latency.get(backend, 0.0)
+        if latency:
+            time.sleep(latency * jitter)
+        if failed:
+            raise FakeBackendError("Injected " + backend + " error on " +
+                                   method)
+
+
+class FakeResponse(object):
+    def __init__(self, body):
+        self.body = body
+
+
+class FakeSlackAPI(object):
+    def __init__(self, slack, name):
+        self.slack  = slack
+        self.name   = name
+
+    def _call(self, method):
+        self.slack.faults.call('slack', self.name + "." + method)
+
+
+class FakeSlackChannels(FakeSlackAPI):
+    def create(self, name):
+        self._call('create')
+        with self.slack.lock:
+            if name in self.slack.channels_by_name:
+                raise SlackerError("name_taken")
+            channel_id = "C" + str(len(self.slack.channels_by_id) + 1).zfill(8)
+            channel = {'id': channel_id, 'name': name,
+                       'purpose': {}, 'topic': {}}
+            self.slack.channels_by_id[channel['id']] = channel
+            self.slack.channels_by_name[name] = channel
+        return FakeResponse({'ok': True, 'channel': dict(channel)})
+
+    def info(self, channel):
+        self._call('info')
+        with self.slack.lock:
+            found = self.slack.channels_by_id.get(channel)
+            if found is None:
+                # Direct messages channels, as in the samples
+                found = {'id': channel, 'name': channel.lower()}
+            return FakeResponse({'ok': True, 'channel': dict(found)})
+
+    def join(self, name):
+        self._call('join')
+        return FakeResponse({'ok': True})
+
+    def invite(self, channel, user):
+        self._call('invite')
+        return FakeResponse({'ok': True})
+
+    def set_purpose(self, channel, purpose):
+        self._call('setPurpose')
+        return FakeResponse({'ok': True, 'purpose': purpose})
+
+    def set_topic(self, channel, topic):
+        self._call('setTopic')
+        with self.slack.lock:
+            self.slack.channels_by_id[channel]['topic'] = {'value': topic}
+        return FakeResponse({'ok': True, 'topic': topic})
+
+    def get(self, api, params=None):
+        """`channels.list`, in a single page"""
+        self._call('list')
+        with self.slack.lock:
+            channels = [dict(channel)
+                        for channel in self.slack.channels_by_id.values()]
+        return FakeResponse({'ok': True, 'channels': channels,
+                             'response_metadata': {'next_cursor': ''}})
+
+
+class FakeSlackChat(FakeSlackAPI):
+    def post_message(self, channel, text, **kwargs):
+        self._call('postMessage')
+        with self.slack.lock:
+            self.slack.messages += 1
+        return FakeResponse({'ok': True, 'channel': channel})
+
+
+class FakeSlackUsers(FakeSlackAPI):
+    def info(self, user):
+        self._call('info')
+        return FakeResponse({'ok': True, 'user': {
+            'id': user, 'name': "user-" + user.lower(),
+            'real_name': "User " + user}})
+
+
+class FakeSlack(object):
+    """Stands for both Slacker clients"""
+    def __init__(self, faults):
+        self.faults             = faults
+        self.lock               = threading.Lock()
+        self.channels_by_id     = {}
+        self.channels_by_name   = {}
+        self.messages           = 0
+        self.channels           = FakeSlackChannels(self, 'channels')
+        self.chat               = FakeSlackChat(self, 'chat')
+        self.users              = FakeSlackUsers(self, 'users')
+
+    def channel_of_topic(self, topic):
+        """ID of the channel with a topic, None if there isn't any"""
+        with self.lock:
+            for channel in self.channels_by_id.values():
+                if channel['topic'].get('value') == topic:
+                    return channel['id']
+
+
+class FakeIssue(object):
+    def __init__(self, key):
+        self.key = key
+
+    def __str__(self):
+        return self.key
+
+
+class FakeJira(object):
+    def __init__(self, faults, project):
+        self.faults     = faults
+        self.project    = project
+        self.lock       = threading.Lock()
+        self.issues     = {}
+
+    def create_issue(self, project, issuetype, summary, description):
+        self.faults.call('jira', 'create_issue')
+        with self.lock:
+            key = project + "-" + str(len(self.issues) + 1)
+            self.issues[summary] = key
+        return FakeIssue(key)
+
+    def create_issues(self, field_list, prefetch=True):
+        self.faults.call('jira', 'create_issues')
+        results = []
+        with self.lock:
+            for fields in field_list:
+                key = fields['project']['key'] + "-" + \
+                    str(len(self.issues) + 1)
+                self.issues[fields['summary']] = key
+                results.append({'status': 'Success', 'issue': FakeIssue(key),
+                                'error': None, 'input_fields': fields})
+        return results
+
+    def transition_issue(self, issue, transition):
+        self.faults.call('jira', 'transition_issue')
+
+    def add_comment(self, issue, body):
+        self.faults.call('jira', 'add_comment')
+
+
+class FakeTransport(object):
+    serializer = JSONSerializer()
+
+
+class FakeElasticsearch(object):
+    """
+    Documents of a single index, with their versions
+
+    Bulk updates understand the partial updates and the append script of
+    `EsWriter`.
+    """
+    transport = FakeTransport()
+
+    def __init__(self, faults):
+        self.faults     = faults
+        self.lock       = threading.Lock()
+        self.docs       = {}
+
+    def _apply(self, doc_id, body):
+        doc = self.docs.get(doc_id)
+        if doc is None:
+            source = body.get('upsert') or body.get('doc') or {}
+            doc = self.docs[doc_id] = {'source': deepcopy(source),
+                                       'version': 1}
+            return doc
+        if 'doc' in body:
+            doc['source'].update(deepcopy(body['doc']))
+        else:
+            params = body['script']['params']
+            doc['source'].setdefault(params['field'], []).extend(
+                deepcopy(params['items']))
+        doc['version'] += 1
+        return doc
+
+    def bulk(self, body, **params):
+        self.faults.call('elasticsearch', 'bulk')
+        lines = [json.loads(line) for line in body.splitlines() if line]
+        items = []
+        with self.lock:
+            for action, source in zip(lines[::2], lines[1::2]):
+                doc_id = str(action['update']['_id'])
+                doc = self._apply(doc_id, source)
+                items.append({'update': {'_id': doc_id, 'status': 200,
+                                         '_version': doc['version']}})
+        return {'errors': False, 'items': items}
+
+    def update(self, index, doc_type, id, body, version=None, **params):
+        self.faults.call('elasticsearch', 'update')
+        if isinstance(body, str):
+            body = json.loads(body)
+        with self.lock:
+            doc = self.docs.get(str(id))
+            if doc is None:
+                raise NotFoundError(404, 'document_missing_exception')
+            if version is not None and doc['version'] != version:
+                raise ConflictError(409, 'version_conflict_engine_exception')
+            doc = self._apply(str(id), body)
+            return {'_id': str(id), '_version': doc['version']}
+
+    def get(self, index, doc_type, id, **params):
+        self.faults.call('elasticsearch', 'get')
+        with self.lock:
+            doc = self.docs.get(str(id))
+            if doc is None:
+                raise NotFoundError(404, 'not_found')
+            return {'_id': str(id), '_version': doc['version'],
+                    '_source': deepcopy(doc['source'])}
+
+    def search(self, index, doc_type, q, **params):
+        self.faults.call('elasticsearch', 'search')
+        field, value = q.split(':', 1)
+        with self.lock:
+            hits = [{'_id': doc_id, '_version': doc['version'],
+                     '_source': deepcopy(doc['source'])}
+                    for doc_id, doc in self.docs.items()
+                    if doc['source'].get(field) == value]
+        return {'hits': {'total': len(hits), 'hits': hits}}
+
+
+class FakeCachet(object):
+    def __init__(self, faults):
+        self.faults     = faults
+        self.lock       = threading.Lock()
+        self.incidents  = 0
+
+    def post(self, **fields):
+        self.faults.call('cachet', 'incidents.post')
+        with self.lock:
+            self.incidents += 1
+            return json.dumps({'data': dict(fields, id=self.incidents)})
+
+    def put(self, id, **fields):
+        self.faults.call('cachet', 'incidents.put')
+        return json.dumps({'data': dict(fields, id=id)})
+
+
+class FakeBackends(object):
+    """Every fake, sharing the same faults"""
+    def __init__(self, faults, jira_project):
+        self.faults = faults
+        self.slack  = FakeSlack(faults)
+        self.jira   = FakeJira(faults, jira_project)
+        self.es     = FakeElasticsearch(faults)
+        self.cachet = FakeCachet(faults)
+
+    def install(self, manager):
+        """Replace the clients of an `IncidentsManager` with the fakes"""
+        manager.slack = self.slack
+        manager.slack_fake_user = self.slack
+        manager.slack_channels.slack = self.slack
+        apiai_user = {'id': "UAPIAI", 'name': "api.ai"}
+        clients = {
+            'slack': apiai_user,
+            'elasticsearch': self.es,
+            'jira': self.jira,
+            'cachet': self.cachet
+        }
+        manager.backends = {
+            name: Backend(name, lambda client=client: client)
+            for name, client in clients.items()
+        }
+        for backend in manager.backends.values():
+            backend.get()
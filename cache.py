@@ -0,0 +1,93 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+class TTLCache(object):
+    """
+    Bounded LRU cache whose entries also expire after `ttl` seconds
+
+    Keeps hits, misses, evictions (entries dropped to stay under `size`) and
+    expirations counters.
+    """
+    def __init__(self, name, size=1000, ttl=300):
+        self.name           = name
+        self.size           = size
+        self.ttl            = ttl
+        self.entries        = OrderedDict()
+        self.lock           = threading.Lock()
+        self.hits           = 0
+        self.misses         = 0
+        self.evictions      = 0
+        self.expirations    = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expiry = entry
+            if expiry < time.monotonic():
+                del self.entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_load(self, key, load):
+        """Get value from cache, calling `load(key)` and caching it on a miss"""
+        value = self.get(key)
+        if value is None:
+            value = load(key)
+            self.put(key, value)
+        return value
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def dump(self):
+        """Entries, least recently used first, with their remaining TTL"""
+        now = time.monotonic()
+        with self.lock:
+            return [[key, value, expiry - now]
+                    for key, (value, expiry) in self.entries.items()
+                    if expiry > now]
+
+    def load(self, entries, elapsed=0):
+        """Put back dumped entries, `elapsed` seconds after the dump"""
+        now = time.monotonic()
+        with self.lock:
+            for key, value, ttl in entries:
+                if ttl > elapsed:
+                    self.entries.pop(key, None)
+                    self.entries[key] = (value, now + ttl - elapsed)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'max_size': self.size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations
+            }
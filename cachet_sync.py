@@ -0,0 +1,57 @@
+import threading
+
+from incident import IncidentState
+
+# Cachet incident statuses
+INVESTIGATING   = 1
+FIXED           = 4
+# Cachet component statuses
+OPERATIONAL     = 1
+MAJOR_OUTAGE    = 4
+
+
+def desired_state(incidents):
+    """
+    Cachet incident fields for incidents declared together, as a single
+    Cachet incident: fixed once all of them are closed
+    """
+    closed = all(incident.state == IncidentState.CLOSED
+                 for incident in incidents)
+    if len(incidents) == 1:
+        name = incidents[0].title
+        message = incidents[0].description
+    else:
+        name = str(len(incidents)) + " incidents: " + \
+            ", ".join(incident.title for incident in incidents)
+        message = "\n\n".join(incident.title + ": " + incident.description
+                              for incident in incidents)
+    return {
+        'name': name,
+        'message': message,
+        'status': FIXED if closed else INVESTIGATING,
+        'component_id': '1',
+        'component_status': OPERATIONAL if closed else MAJOR_OUTAGE
+    }
+
+
+class CachetSync(object):
+    """
+    Last state synced to each Cachet incident, to only send what changed
+
+    The state is only known for the Cachet incidents synced by this process:
+    the first sync of another one sends every field.
+    """
+    def __init__(self):
+        self.synced = {}
+        self.lock   = threading.Lock()
+
+    def changes(self, cachet_id, desired):
+        """Fields of `desired` that differ from the last synced state"""
+        with self.lock:
+            synced = self.synced.get(cachet_id, {})
+        return {name: value for name, value in desired.items()
+                if synced.get(name) != value}
+
+    def synced_as(self, cachet_id, fields):
+        with self.lock:
+            self.synced.setdefault(cachet_id, {}).update(fields)
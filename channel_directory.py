@@ -0,0 +1,58 @@
+import threading
+
+from log import log
+from resilience import resilience
+
+
+class ChannelDirectory(object):
+    """
+    Index of Slack channels by name
+
+    Filled incrementally: from the channels we create or already know about,
+    and from the pages of `channels.list` read while looking for a channel we
+    don't know yet. Only channel IDs and names are kept.
+    """
+    def __init__(self, slack, page_size=1000):
+        self.slack      = slack
+        self.page_size  = page_size
+        self.by_name    = {}
+        self.lock       = threading.Lock()
+
+    def add(self, channel):
+        with self.lock:
+            self.by_name[channel['name']] = {'id': channel['id'],
+                                             'name': channel['name']}
+
+    def channels(self):
+        with self.lock:
+            return list(self.by_name.values())
+
+    def lookup(self, name):
+        """Find a channel by name, listing channels from Slack on a miss"""
+        with self.lock:
+            channel = self.by_name.get(name)
+        if channel is not None:
+            return channel
+        log.debug("Channel %s not indexed yet, listing channels ...", name)
+        for channel in self.iter_channels():
+            self.add(channel)
+            if channel['name'] == name:
+                log.debug("... found channel %s", name)
+                return self.by_name[name]
+        log.debug("... channel %s not found", name)
+
+    def iter_channels(self):
+        """Stream every channel, one `channels.list` page at a time"""
+        cursor = None
+        while True:
+            with resilience.guard('slack', 'channels.list'):
+                page = self.slack.channels.get('channels.list', params={
+                    'exclude_members': 'true',
+                    'limit': self.page_size,
+                    'cursor': cursor
+                }).body
+            for channel in page['channels']:
+                yield channel
+            cursor = page.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                return
@@ -0,0 +1,74 @@
+from datetime import datetime
+import json
+
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+def encode_date(value):
+    return value.isoformat(timespec='seconds')
+
+
+def decode_date(value):
+    # fromisoformat is several times faster than strptime
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return datetime.strptime(value, DATE_FORMAT)
+
+
+def encode_enum(value):
+    return value.value
+
+
+def dumps(source):
+    """Compact JSON"""
+    return json.dumps(source, separators=(',', ':'), ensure_ascii=False)
+
+
+class Field(object):
+    """
+    Attribute of a model, with how to encode it to JSON-compatible values
+    and decode it back
+
+    `None` is never encoded nor decoded. Optional fields are left out of the
+    encoded document when `None`.
+    """
+    __slots__ = ('name', 'encode', 'decode', 'optional')
+
+    def __init__(self, name, encode=None, decode=None, optional=False):
+        self.name       = name
+        self.encode     = encode
+        self.decode     = decode
+        self.optional   = optional
+
+
+class Schema(object):
+    """Ordered fields of a `__slots__` model"""
+    def __init__(self, *fields):
+        self.fields = fields
+        self.names  = tuple(field.name for field in fields)
+
+    def to_dict(self, obj, exclude=()):
+        source = {}
+        for field in self.fields:
+            if field.name in exclude:
+                continue
+            value = getattr(obj, field.name)
+            if value is None:
+                if field.optional:
+                    continue
+            elif field.encode is not None:
+                value = field.encode(value)
+            source[field.name] = value
+        return source
+
+    def from_dict(self, obj, source):
+        """Set the fields present in `source`, ignoring unknown keys"""
+        for field in self.fields:
+            if field.name not in source:
+                continue
+            value = source[field.name]
+            if value is not None and field.decode is not None:
+                value = field.decode(value)
+            setattr(obj, field.name, value)
+        return obj
@@ -0,0 +1,115 @@
+import threading
+
+from elasticsearch import RequestsHttpConnection
+from requests.adapters import HTTPAdapter
+
+from config import config
+from log import log
+
+DEFAULT_POOL_SIZE   = 10
+DEFAULT_TIMEOUT     = 10
+
+
+class PooledAdapter(HTTPAdapter):
+    """
+    HTTP adapter keeping connections alive per host, with a default timeout
+
+    Tracks in-flight requests to report how saturated the pool is: requests
+    beyond `pool_size` at once open throwaway connections, paying a new TCP
+    and TLS handshake each.
+    """
+    def __init__(self, backend, pool_size=DEFAULT_POOL_SIZE,
+                 timeout=DEFAULT_TIMEOUT, max_retries=0):
+        self.backend        = backend
+        self.pool_size      = pool_size
+        self.timeout        = timeout
+        self.in_flight      = 0
+        self.peak_in_flight = 0
+        self.requests       = 0
+        self.overflows      = 0
+        self.stats_lock     = threading.Lock()
+        super(PooledAdapter, self).__init__(pool_connections=4,
+                                            pool_maxsize=pool_size,
+                                            max_retries=max_retries)
+
+    def send(self, request, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self.timeout
+        with self.stats_lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            if self.in_flight > self.pool_size:
+                self.overflows += 1
+        try:
+            return super(PooledAdapter, self).send(request, timeout=timeout,
+                                                   **kwargs)
+        finally:
+            with self.stats_lock:
+                self.in_flight -= 1
+
+    def stats(self):
+        with self.stats_lock:
+            return {
+                'pool_size': self.pool_size,
+                'timeout': self.timeout,
+                'in_flight': self.in_flight,
+                'peak_in_flight': self.peak_in_flight,
+                'saturation': float(self.in_flight) / self.pool_size,
+                'requests': self.requests,
+                'overflows': self.overflows
+            }
+
+
+class ConnectionPools(object):
+    """
+    One connection pool per backend, shared by every client of that backend
+
+    Pool sizes and timeouts come from the `connections` configuration, per
+    backend, falling back on `connections.default`.
+    """
+    def __init__(self, pools_config):
+        self.config     = pools_config
+        self.adapters   = {}
+        self.lock       = threading.Lock()
+
+    def adapter(self, backend):
+        with self.lock:
+            adapter = self.adapters.get(backend)
+            if adapter is None:
+                backend_config = dict(self.config.get('default', {}),
+                                      **self.config.get(backend, {}))
+                adapter = PooledAdapter(
+                    backend,
+                    pool_size=backend_config.get('pool_size',
+                                                 DEFAULT_POOL_SIZE),
+                    timeout=backend_config.get('timeout', DEFAULT_TIMEOUT))
+                log.debug("Created connection pool for %s (%s connections)",
+                          backend, adapter.pool_size)
+                self.adapters[backend] = adapter
+            return adapter
+
+    def timeout(self, backend):
+        return self.adapter(backend).timeout
+
+    def mount(self, session, backend):
+        """Make a requests session use the backend's pool"""
+        adapter = self.adapter(backend)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def stats(self):
+        with self.lock:
+            adapters = list(self.adapters.values())
+        return {adapter.backend: adapter.stats() for adapter in adapters}
+
+
+pools = ConnectionPools(config.get('connections', {}))
+
+
+class PooledRequestsHttpConnection(RequestsHttpConnection):
+    """Elasticsearch connection going through the shared `elasticsearch` pool"""
+    def __init__(self, *args, **kwargs):
+        super(PooledRequestsHttpConnection, self).__init__(*args, **kwargs)
+        pools.mount(self.session, 'elasticsearch')
@@ -0,0 +1,115 @@
+from collections import OrderedDict
+import json
+import os
+import threading
+
+from log import log
+
+
+class DedupStore(object):
+    """
+    Results of already handled requests, to answer retries without running
+    them again
+
+    A request is known by several keys (e.g. Dialogflow's responseId and the
+    Slack message ID): if any of them was already handled, its result is
+    returned. A request still running is waited for. Failed requests are not
+    remembered, so that a retry runs them again.
+
+    The last `size` results are kept in memory and, if `path` is set,
+    appended to that file and reloaded from it at startup.
+    """
+    def __init__(self, size=10000, path=None):
+        self.size       = size
+        self.path       = path
+        self.results    = OrderedDict()
+        self.in_flight  = {}
+        self.lock       = threading.Lock()
+        self.file_lines = 0
+        if self.path is not None:
+            self._load()
+
+    def run(self, keys, func):
+        """
+        Return the result of the request known by `keys`, calling `func` to
+        get it unless it was already handled
+        """
+        keys = [key for key in keys if key]
+        if not keys:
+            return func()
+        while True:
+            with self.lock:
+                for key in keys:
+                    if key in self.results:
+                        self.results.move_to_end(key)
+                        log.info("Request %s already handled, returning "
+                                 "previous result", key)
+                        return self.results[key]
+                running = next((self.in_flight[key] for key in keys
+                                if key in self.in_flight), None)
+                if running is None:
+                    running = threading.Event()
+                    for key in keys:
+                        self.in_flight[key] = running
+                    break
+            log.info("Request %s already running, waiting ...", keys[0])
+            running.wait()
+        try:
+            result = func()
+            self._remember(keys, result)
+            return result
+        finally:
+            with self.lock:
+                for key in keys:
+                    self.in_flight.pop(key, None)
+            running.set()
+
+    def _remember(self, keys, result):
+        with self.lock:
+            for key in keys:
+                self.results.pop(key, None)
+                self.results[key] = result
+            while len(self.results) > self.size:
+                self.results.popitem(last=False)
+            if self.path is not None:
+                self._append(keys, result)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        log.info("Loading handled requests from %s ...", self.path)
+        with open(self.path, 'r') as dedup_file:
+            for line in dedup_file:
+                self.file_lines += 1
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Partially written last line
+                    continue
+                for key in entry['keys']:
+                    self.results.pop(key, None)
+                    self.results[key] = entry['result']
+                while len(self.results) > self.size:
+                    self.results.popitem(last=False)
+        log.info("... loaded %s handled requests", len(self.results))
+
+    def _append(self, keys, result):
+        with open(self.path, 'a') as dedup_file:
+            dedup_file.write(json.dumps({'keys': keys, 'result': result}) +
+                             "\n")
+        self.file_lines += 1
+        # Keep the file from growing forever: rewrite it from memory
+        if self.file_lines > 2 * self.size:
+            self._compact()
+
+    def _compact(self):
+        by_result = OrderedDict()
+        for key, result in self.results.items():
+            by_result.setdefault(id(result), (result, []))[1].append(key)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as dedup_file:
+            for result, keys in by_result.values():
+                dedup_file.write(json.dumps({'keys': keys, 'result': result}) +
+                                 "\n")
+        os.replace(tmp_path, self.path)
+        self.file_lines = len(by_result)
@@ -0,0 +1,193 @@
+from collections import OrderedDict
+import atexit
+import json
+import threading
+
+from elasticsearch import helpers
+
+from log import log
+from resilience import resilience
+import codec
+
+# Appends items to a list field, creating it if needed
+APPEND_SCRIPT = ("if (ctx._source[params.field] == null) "
+                 "{ ctx._source[params.field] = [] } "
+                 "ctx._source[params.field].addAll(params.items)")
+
+
+def merge_docs(older_json, newer_json):
+    """Partial update writing the fields of both, the newer ones winning"""
+    if older_json == newer_json:
+        return newer_json
+    doc = json.loads(older_json)
+    doc.update(json.loads(newer_json))
+    return codec.dumps(doc)
+
+
+class EsWriter(object):
+    """
+    Write-behind buffer for incident documents
+
+    Writes are acknowledged as soon as they are buffered, and flushed through
+    the bulk API once `batch_size` operations are pending or every
+    `flush_interval` seconds. Only writes that need to be searchable right
+    away pay for a `refresh=wait_for`.
+
+    Two kinds of writes are buffered, both as partial updates so that their
+    cost doesn't depend on the size of the document:
+    - `update` writes some fields of a document; repeated updates of the same
+      document are coalesced into one, the last value of each field winning
+    - `append` adds items to a list field of a document; the items appended
+      to the same field are sent in order, in a single scripted update
+
+    `get_es` returns the Elasticsearch client, it is only called to flush.
+    """
+    def __init__(self, get_es, es_index, doc_type="incident", batch_size=100,
+                 flush_interval=1.0):
+        self.get_es         = get_es
+        self.es_index       = es_index
+        self.doc_type       = doc_type
+        self.batch_size     = batch_size
+        self.flush_interval = flush_interval
+        self.updates        = OrderedDict()
+        self.appends        = OrderedDict()
+        self.lock           = threading.Lock()
+        self.flush_lock     = threading.Lock()
+        self.wakeup         = threading.Condition(self.lock)
+        self.thread         = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="es-writer",
+                                       daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def _pending(self):
+        return len(self.updates) + len(self.appends)
+
+    def update(self, doc_id, doc_json, wait=False, version=None):
+        """
+        Buffer a partial update of a document, given as JSON, creating the
+        document if needed
+
+        With `wait`, the buffer is flushed right away and searchable when this
+        returns.
+
+        With `version`, the update is only applied if the document is still at
+        that version: it is sent right away, the new version is returned, and
+        `elasticsearch.ConflictError` is raised if someone else wrote the
+        document since.
+        """
+        if version is not None:
+            return self._update_version(doc_id, doc_json, version, wait)
+        with self.lock:
+            previous = self.updates.pop(doc_id, None)
+            if previous is not None:
+                doc_json = merge_docs(previous, doc_json)
+            self.updates[doc_id] = doc_json
+            if self._pending() >= self.batch_size:
+                self.wakeup.notify()
+        if wait:
+            self.flush(refresh='wait_for')
+
+    def _update_version(self, doc_id, doc_json, version, wait):
+        # Our own buffered writes go first
+        self.flush()
+        # Reads by ID are realtime: only searches need a refresh
+        params = {'refresh': 'wait_for'} if wait else {}
+        with resilience.guard('elasticsearch', 'update'):
+            res = self.get_es().update(
+                index=self.es_index, doc_type=self.doc_type, id=doc_id,
+                body='{"doc":' + doc_json + '}', version=version, **params)
+        return res['_version']
+
+    def append(self, doc_id, field, item_json):
+        """Buffer an item, given as JSON, to add to a list field"""
+        with self.lock:
+            self.appends.setdefault((doc_id, field), []).append(item_json)
+            if self._pending() >= self.batch_size:
+                self.wakeup.notify()
+
+    def _operations(self, updates, appends):
+        """Bulk actions for the buffered writes, with what to requeue them"""
+        for doc_id, doc_json in updates.items():
+            yield ('update', doc_id, doc_json), {
+                '_op_type': 'update',
+                '_index': self.es_index,
+                '_type': self.doc_type,
+                '_id': doc_id,
+                '_retry_on_conflict': 3,
+                '_source': '{"doc":' + doc_json + ',"doc_as_upsert":true}'
+            }
+        for (doc_id, field), items in appends.items():
+            items_json = '[' + ','.join(items) + ']'
+            yield ('append', (doc_id, field), items), {
+                '_op_type': 'update',
+                '_index': self.es_index,
+                '_type': self.doc_type,
+                '_id': doc_id,
+                '_retry_on_conflict': 3,
+                '_source': '{"script":{"lang":"painless","source":"' +
+                           APPEND_SCRIPT + '","params":{"field":"' + field +
+                           '","items":' + items_json + '}},"upsert":{"' +
+                           field + '":' + items_json + '}}'
+            }
+
+    def flush(self, refresh=False):
+        # Flushes are serialized so an older batch can never land after a
+        # newer one
+        with self.flush_lock:
+            with self.lock:
+                updates, self.updates = self.updates, OrderedDict()
+                appends, self.appends = self.appends, OrderedDict()
+            if not updates and not appends:
+                return
+            operations = list(self._operations(updates, appends))
+            log.debug("Flushing %s operations to ES ...", len(operations))
+            failed = []
+            done = 0
+            # Failed bulk requests raise through the guard, for the breaker
+            # to count them. Whatever wasn't written is requeued, even when
+            # the guard refused the call
+            # noinspection PyBroadException
+            try:
+                with resilience.guard('elasticsearch', 'bulk'):
+                    for ok, result in helpers.streaming_bulk(
+                            self.get_es(),
+                            [action for _, action in operations],
+                            raise_on_error=False, raise_on_exception=True,
+                            refresh=refresh):
+                        if not ok:
+                            log.error("Failed ES operation: %s", result)
+                            failed.append(operations[done][0])
+                        done += 1
+            except Exception:
+                log.exception("Bulk request to ES failed")
+                failed.extend(op for op, _ in operations[done:])
+            if failed:
+                self._requeue(failed)
+                raise Exception("Failed to flush " + str(len(failed)) +
+                                " operations to ES, will retry")
+            log.debug("... flushed operations")
+
+    def _requeue(self, operations):
+        with self.lock:
+            for kind, key, payload in operations:
+                if kind == 'update':
+                    # Fields written since win over the failed ones
+                    if key in self.updates:
+                        payload = merge_docs(payload, self.updates[key])
+                    self.updates[key] = payload
+                else:
+                    # Failed items go before the ones appended since
+                    self.appends[key] = payload + self.appends.get(key, [])
+
+    def _run(self):
+        while True:
+            with self.lock:
+                self.wakeup.wait(self.flush_interval)
+            # noinspection PyBroadException
+            try:
+                self.flush()
+            except Exception:
+                log.exception("Failed to flush writes to ES")
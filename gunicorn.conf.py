@@ -0,0 +1,11 @@
+# Gunicorn settings, from the "server" section of config.json
+from config import config
+
+server = config.get('server', {})
+
+bind            = server.get('bind', '0.0.0.0:5000')
+workers         = server.get('workers', 1)
+# Threads of each worker: requests mostly wait on backends
+threads         = server.get('threads', 8)
+worker_class    = 'gthread'
+timeout         = server.get('timeout', 60)
@@ -1,21 +1,43 @@
 from enum import Enum
-import json
 from datetime import datetime
-from jira.exceptions import JIRAError
 
 from config import config
 from log import log
+from plan import ExecutionPlan
+from resilience import resilience
+import codec
+from codec import Field, Schema
 
-DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
 
+# Slack advises to keep messages under 4000 characters
+MESSAGE_MAX_LENGTH = 4000
 
-class DumbEncoder(json.JSONEncoder):
-    def default(self, o):
-        if isinstance(o, datetime):
-            return o.strftime('%Y-%m-%dT%H:%M:%S%z')
-        if isinstance(o, IncidentState) or isinstance(o, IncidentPriority):
-            return o.value
-        return o.__str__()
+
+def chunk_lines(title, lines, max_length):
+    """
+    Group lines into code block messages of at most `max_length` characters,
+    the first one starting with `title`
+
+    Lines are consumed lazily, and truncated if they can't fit in a message
+    on their own.
+    """
+    header = title + "\n```"
+    footer = "```"
+    chunk = []
+    length = len(header) + len(footer)
+    for line in lines:
+        room = max_length - len(header) - len(footer)
+        if len(line) > room:
+            line = line[:room - 1] + "…"
+        if chunk and length + len(line) + 1 > max_length:
+            yield header + "\n".join(chunk) + footer
+            header = "```"
+            chunk = []
+            length = len(header) + len(footer)
+        chunk.append(line)
+        length += len(line) + 1
+    if chunk:
+        yield header + "\n".join(chunk) + footer
 
 
 class IncidentState(Enum):
@@ -28,10 +50,67 @@ class IncidentPriority(Enum):
     RED     = "red"
 
 
+PRIORITY_COLORS = {
+    IncidentPriority.ORANGE: "#ffa500",
+    IncidentPriority.RED: "#ff2600"
+}
+
+# Jira issues links start the same way
+JIRA_BROWSE_URL = "<" + config['jira']['host'] + "/browse/"
+
+
+class Update(object):
+    SCHEMA = Schema(
+        Field('message'),
+        Field('author', optional=True),
+        Field('date', codec.encode_date, codec.decode_date)
+    )
+    __slots__ = SCHEMA.names
+
+    def __init__(self, message=None, author=None, date=None):
+        self.message    = message
+        self.author     = author
+        self.date       = date
+
+    def to_dict(self):
+        return self.SCHEMA.to_dict(self)
+
+    @classmethod
+    def from_dict(cls, source):
+        return cls.SCHEMA.from_dict(cls(), source)
+
+
 class Incident(object):
+    SCHEMA = Schema(
+        Field('state', codec.encode_enum, IncidentState),
+        Field('id'),
+        Field('title'),
+        Field('description'),
+        Field('priority', codec.encode_enum, IncidentPriority),
+        Field('slack_channel'),
+        Field('slack_channel_id'),
+        Field('opening_time', codec.encode_date, codec.decode_date),
+        Field('closing_time', codec.encode_date, codec.decode_date),
+        Field('starting_time', codec.encode_date, codec.decode_date),
+        Field('ending_time', codec.encode_date, codec.decode_date),
+        Field('updates',
+              lambda updates: [update.to_dict() for update in updates],
+              lambda updates: [Update.from_dict(update)
+                               for update in updates]),
+        Field('jira_issue'),
+        Field('cachet_id'),
+        # Last write, for restarts to catch up on what changed since their
+        # snapshot
+        Field('updated_time', codec.encode_date, codec.decode_date,
+              optional=True)
+    )
+    # The manager gives access to the backends, and the version is the one of
+    # the Elasticsearch document when it was loaded: they are not serialized
+    __slots__ = SCHEMA.names + ('manager', 'version')
+
     def __init__(self, incident_id=0, priority=IncidentPriority.RED,
-                 title="Undefined", description="Undefined"):
-        print("Creating incident " + str(incident_id) + " ...")
+                 title="Undefined", description="Undefined", manager=None):
+        log.debug("Creating incident %s ...", incident_id)
         self.state          = IncidentState.ONGOING
         self.id             = incident_id
         self.title          = title
@@ -46,181 +125,204 @@ class Incident(object):
         self.updates        = []
         self.jira_issue     = config['jira']['project'] + "-" + str(self.id)
         self.cachet_id      = None
-        print("Created incident")
+        self.updated_time   = None
+        self.manager        = manager
+        self.version        = None
+        log.debug("Created incident")
 
     def close(self):
-        from app import incidents
-        print("Closing incident " + str(self.id) + " ... ")
+        log.debug("Closing incident %s ...", self.id)
         self.state          = IncidentState.CLOSED
         self.closing_time   = datetime.now()
         self.ending_time    = self.closing_time
-        self.send_to_es()
+        # The incident is closed locally, every backend can be told at once
+        plan = ExecutionPlan("close incident " + str(self.id))
+        plan.add('es', self.send_to_es)
+        plan.add('slack_confirmation', self.post_close_confirmation)
+        plan.add('slack_updates', self.list_updates,
+                 depends_on=['slack_confirmation'])
+        plan.add('jira', self.close_jira_issue)
+        plan.add('cachet', self.sync_to_cachet)
+        plan.run()
+
+    def post_close_confirmation(self):
         log.debug("Sending confirmation to Slack ...")
-        incidents.slack.chat.post_message(
-            channel = self.slack_channel,
-            text    = '',
-            as_user = True,
-            attachments = [
-                {
-                    "text": "Closing this incident, good job :+1:",
-                    "color": "good",
-                    "mrkdwn_in": ["text"],
-                    "short": False,
-                    "fields": [
-                        {
-                            "title": "Jira Issue",
-                            "value": "<{jira_server}/browse/{jira_issue}"
-                                     "|{jira_issue}>".format(
-                                        jira_server=config['jira']['host'],
-                                        jira_issue=self.jira_issue),
-                            "short": True
-                        },
-                        {
-                            "title": "State",
-                            "value": self.state.value,
-                            "short": True
-                        }
-                    ]
-                }
-            ]
-        )
+        with resilience.guard('slack', 'chat.postMessage'):
+            self.manager.slack.chat.post_message(
+                channel = self.slack_channel,
+                as_user = True,
+                **self.manager.templates.render('close_confirmation',
+                                                self.template_values())
+            )
         log.debug("Sent confirmation to Slack")
-        self.list_updates()
-        log.debug("Updating Jira issue ...")
-        try:
-            incidents.jira.transition_issue(self.jira_issue, "41")
-        except JIRAError:
-            pass
-        log.debug("Updated Jira issue")
-        log.debug("Updating Cachet ...")
-        self.declare_to_cachet()
-        log.debug("Updated Cachet")
+
+    def jira_link(self):
+        """Slack link to the Jira issue"""
+        if self.jira_issue is None:
+            # Jira was down when the incident was created
+            return "Not created yet"
+        return JIRA_BROWSE_URL + self.jira_issue + "|" + self.jira_issue + ">"
+
+    def template_values(self):
+        """Values of the Slack messages templates, see `slack_templates.py`"""
+        return {
+            'id': str(self.id),
+            'title': str(self.title),
+            'description': str(self.description),
+            'state': self.state.value,
+            'priority': self.priority.value,
+            'color': self.get_color(),
+            'jira_link': self.jira_link(),
+            'slack_channel': self.slack_channel,
+            'slack_channel_id': str(self.slack_channel_id)
+        }
+
+    def close_jira_issue(self):
+        log.debug("Queuing Jira issue transition")
+        self.manager.outbox.enqueue('jira', 'transition_issue', {
+            'issue': self.jira_issue,
+            'slack_channel_id': self.slack_channel_id,
+            'transition': "41"
+        }, key=self.slack_channel_id)
 
     def set_description(self, new_description):
-        log.debug("Updating description for incident " + str(self.id) + " ... ")
-        from app import incidents
+        log.debug("Updating description for incident %s ...", self.id)
         self.description = new_description
         self.send_to_es()
         log.debug("Updated description")
+        self.sync_to_cachet()
         log.debug("Sending confirmation to Slack ...")
-        incidents.slack.channels.set_purpose(
-            channel = self.slack_channel_id,
-            purpose = "Incident " + self.priority.value.upper() + " " +
-                      str(self.id) + " - Incident management room\n\n" +
-                      new_description
-        )
-        print("Sent confirmation to Slack")
+        with resilience.guard('slack', 'channels.setPurpose'):
+            self.manager.slack.channels.set_purpose(
+                channel = self.slack_channel_id,
+                purpose = "Incident " + self.priority.value.upper() + " " +
+                          str(self.id) + " - Incident management room\n\n" +
+                          new_description
+            )
+        self.manager.invalidate_slack_channel(self.slack_channel_id)
+        log.debug("Sent confirmation to Slack")
 
     def add_update(self, message, user):
         log.info("Adding update ...")
-        from app import incidents
-        date = datetime.now()
-        self.updates.append({'message': message, 'author': user, 'date': date})
+        update = Update(message, user, datetime.now())
         log.debug("Ack Slack")
-        incidents.slack.chat.post_message(
-            channel = self.slack_channel,
-            text    = '',
-            as_user = True,
-            attachments = [
-                {
-                    "text": "Just logged a new update for this incident." +
-                            " The message was: " + message,
-                    "mrkdwn_in": ["text"]
-                }
-            ]
-        )
-        self.send_to_es()
-        log.debug("Adding comment to Jira")
-        incidents.jira.add_comment(self.jira_issue, message)
-
-    def list_updates(self):
-        print("Listing updates for incident " + str(self.id) + " ... ")
-        from app import incidents
-        if len(self.updates) == 0:
-            message = "No updates were logged for this incident."
+        with resilience.guard('slack', 'chat.postMessage'):
+            self.manager.slack.chat.post_message(
+                channel = self.slack_channel,
+                text    = '',
+                as_user = True,
+                attachments = [
+                    {
+                        "text": "Just logged a new update for this incident." +
+                                " The message was: " + message,
+                        "mrkdwn_in": ["text"]
+                    }
+                ]
+            )
+        # The incident only changes once acked: a failed command, retried
+        # by Dialogflow, leaves nothing behind
+        self.updates.append(update)
+        self.updated_time = update.date
+        # Only the new update is sent, not the whole history
+        self.manager.store.put(self)
+        self.manager.es_writer.append(
+            self.id, 'updates', codec.dumps(update.to_dict()))
+        self.manager.es_writer.update(self.id, codec.dumps(
+            {'updated_time': codec.encode_date(update.date)}))
+        log.debug("Queuing comment to Jira")
+        self.manager.outbox.enqueue('jira', 'add_comment', {
+            'issue': self.jira_issue,
+            'slack_channel_id': self.slack_channel_id,
+            'body': message
+        }, key=self.slack_channel_id)
+
+    def list_updates(self, start=None, end=None, last=None):
+        """
+        Post updates to Slack, all of them or only updates `start` to `end`
+        (0-based, `end` excluded), or the `last` ones
+
+        Updates are formatted one by one and sent in as many messages as
+        needed to stay under Slack's message size limit.
+        """
+        log.debug("Listing updates for incident %s ...", self.id)
+        if last is not None:
+            start = max(0, len(self.updates) - last)
+            end = None
+        start, end, _ = slice(start, end).indices(len(self.updates))
+        if start >= end:
+            messages = ["No updates were logged for this incident."]
         else:
-            message = "Here are the updates for this incident:\n```" +\
-                      "\n".join([
-                      self.format_update(update, idx)
-                      for idx, update in enumerate(self.updates)]) + "```",
-        incidents.slack.chat.post_message(
-            channel = self.slack_channel,
-            text    = message,
-            as_user = True
-        )
-        print("Sent updates to Slack")
+            messages = chunk_lines(
+                "Here are the updates for this incident:",
+                (self.format_update(self.updates[idx], idx)
+                 for idx in range(start, end)),
+                config['slack'].get('message_max_length',
+                                    MESSAGE_MAX_LENGTH))
+        for message in messages:
+            with resilience.guard('slack', 'chat.postMessage'):
+                self.manager.slack.chat.post_message(
+                    channel = self.slack_channel,
+                    text    = message,
+                    as_user = True
+                )
+        log.debug("Sent updates to Slack")
 
     def get_color(self):
         """Get color code from incident priority"""
-        if self.priority == IncidentPriority.ORANGE:
-            return "#ffa500"
-        elif self.priority == IncidentPriority.RED:
-            return "#ff2600"
-
-    def send_to_es(self):
-        """Send incident to ElasticSearch"""
-        from app import incidents
+        return PRIORITY_COLORS.get(self.priority)
+
+    def send_to_es(self, wait=False):
+        """
+        Send incident to ElasticSearch
+
+        The write is buffered and acknowledged locally, unless `wait` is set:
+        the incident is then flushed and searchable when this returns.
+
+        If the incident was loaded with its version, the write is only applied
+        if nobody else wrote it since, and raises
+        `elasticsearch.ConflictError` otherwise.
+        """
+        self.updated_time = datetime.now()
         log.debug("Sending incident to ES ...")
-        incidents.es.index(
-            index = incidents.es_index,
-            doc_type="incident",
-            id = self.id,
-            body = self.serialize()
-        )
-        print("Sent incident to ES")
-        print("Refreshing ES index ...")
-        incidents.es.indices.refresh(index=incidents.es_index)
-        print("Refreshed index")
-
-    def declare_to_cachet(self):
-        from app import incidents
-        log.info("Declaring incident to Cachet ...")
-        if self.state == IncidentState.CLOSED:
-            status = 4
-            component_status = 1
-        else:
-            status = 1
-            component_status = 4
-        new_cachet_incident = json.loads(incidents.cachet_client.post(
-            name=self.title,
-            message=self.description,
-            status=status,
-            component_id='1',
-            component_status=component_status))
-        self.cachet_id = new_cachet_incident['data']['id']
+        # Updates are appended one by one by `add_update`
+        version = self.manager.es_writer.update(
+            self.id, self.serialize_header(), wait=wait, version=self.version)
+        if version is not None:
+            self.version = version
+        # Only once accepted: a conflicting write must not show in queries
+        self.manager.store.put(self)
+        self.manager.index.put(self)
+        log.debug("Sent incident to ES")
+
+    def sync_to_cachet(self):
+        """Queue a sync of its state to Cachet, see `IncidentsManager`"""
+        log.info("Queuing incident sync to Cachet")
+        self.manager.queue_cachet_sync([self])
 
     @staticmethod
     def format_update(update, idx):
         """Format an update for Slack"""
-        if 'author' in update:
-            author_str = " - <@" + update['author']['id'] + ">"
+        if update.author is not None:
+            author_str = " - <@" + update.author['id'] + ">"
         else:
             author_str = ""
         return "Update n°{number} ({date}{author}) - {message}".format(
                     number = str(idx + 1),
-                    date = update['date'].strftime("%Y-%m-%d %H:%M:%S"),
+                    date = update.date.strftime("%Y-%m-%d %H:%M:%S"),
                     author = author_str,
-                    message = update['message']
+                    message = update.message
         )
 
     def serialize(self):
-        return json.dumps(self.__dict__, indent=4,
-                          cls=DumbEncoder, ensure_ascii=False)
+        """Serialize the whole incident, as stored in Elasticsearch"""
+        return codec.dumps(self.SCHEMA.to_dict(self))
+
+    def serialize_header(self):
+        """Serialize everything but the updates"""
+        return codec.dumps(self.SCHEMA.to_dict(self, exclude=('updates',)))
 
     def unserialize(self, source_json):
         log.debug("Unserializing incident from json ...")
-        log.debug(source_json)
-        self.__dict__ = source_json
-        self.opening_time = datetime.strptime(self.opening_time, DATE_FORMAT)
-        self.starting_time = datetime.strptime(self.starting_time, DATE_FORMAT)
-        self.priority = IncidentPriority(self.priority)
-        self.state = IncidentState(self.state)
-        if self.state == IncidentState.CLOSED:
-            self.closing_time = datetime.strptime(self.closing_time,
-                                                  DATE_FORMAT)
-        for idx, update in enumerate(self.updates):
-            self.updates[idx]['date'] = datetime.strptime(update['date'],
-                                                          DATE_FORMAT)
-        # print(self.serialize())
-        print("... unserialized")
+        self.SCHEMA.from_dict(self, source_json)
+        log.debug("... unserialized")
         return self
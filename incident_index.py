@@ -0,0 +1,250 @@
+import base64
+import bisect
+import threading
+
+from elasticsearch import helpers
+
+from log import log
+from incident import Incident, IncidentState, IncidentPriority
+import codec
+
+DEFAULT_LIMIT   = 50
+MAX_LIMIT       = 500
+
+
+def encode_cursor(key):
+    """Opaque cursor from an index key, (opening timestamp, ID)"""
+    return base64.urlsafe_b64encode(
+        "{!r}:{}".format(key[0], key[1]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        timestamp, incident_id = base64.urlsafe_b64decode(
+            cursor.encode()).decode().split(':', 1)
+        return float(timestamp), int(incident_id)
+    except ValueError:
+        raise ValueError("Invalid cursor " + cursor)
+
+
+def parse_date(value):
+    """
+    Query string date, as in the incidents documents
+
+    Those are naive local times: dates with an offset are converted to one.
+    """
+    try:
+        date = codec.decode_date(value)
+    except ValueError:
+        raise ValueError("Invalid date " + value)
+    if date.tzinfo is not None:
+        date = date.astimezone().replace(tzinfo=None)
+    return date
+
+
+class IncidentSummary(object):
+    """What the index keeps of an incident: everything but its updates"""
+    FIELDS = ('id', 'title', 'description', 'state', 'priority',
+              'opening_time', 'closing_time', 'slack_channel',
+              'slack_channel_id', 'jira_issue', 'cachet_id', 'updated_time')
+    __slots__ = FIELDS
+
+    def __init__(self, incident):
+        for name in self.FIELDS:
+            setattr(self, name, getattr(incident, name))
+
+    @property
+    def key(self):
+        """Incidents are sorted by opening time, then ID"""
+        opening = self.opening_time.timestamp() if self.opening_time else 0.0
+        return opening, self.id
+
+    @property
+    def resolution_time(self):
+        """Seconds from opening to closing, None while ongoing"""
+        if self.state != IncidentState.CLOSED or self.closing_time is None \
+                or self.opening_time is None:
+            return None
+        return (self.closing_time - self.opening_time).total_seconds()
+
+    def to_dict(self):
+        return Incident.SCHEMA.to_dict(self, exclude=('updates',
+                                                      'starting_time',
+                                                      'ending_time'))
+
+
+class Aggregates(object):
+    """Counts and resolution times by priority, kept up to date on writes"""
+    def __init__(self):
+        self.open       = {priority: 0 for priority in IncidentPriority}
+        self.closed     = {priority: 0 for priority in IncidentPriority}
+        self.resolution = {priority: 0.0 for priority in IncidentPriority}
+
+    def add(self, summary, sign=1):
+        if summary.state == IncidentState.CLOSED:
+            self.closed[summary.priority] += sign
+            self.resolution[summary.priority] += \
+                sign * (summary.resolution_time or 0.0)
+        else:
+            self.open[summary.priority] += sign
+
+    def remove(self, summary):
+        self.add(summary, sign=-1)
+
+    def to_dict(self):
+        closed = sum(self.closed.values())
+        resolution = sum(self.resolution.values())
+        return {
+            'open': sum(self.open.values()),
+            'closed': closed,
+            'mttr_seconds': resolution / closed if closed else None,
+            'by_priority': {
+                priority.value: {
+                    'open': self.open[priority],
+                    'closed': self.closed[priority],
+                    'mttr_seconds': (self.resolution[priority] /
+                                     self.closed[priority]
+                                     if self.closed[priority] else None)
+                } for priority in IncidentPriority
+            }
+        }
+
+
+class IncidentIndex(object):
+    """
+    In-process secondary index of every incident, for `/incidents` queries
+
+    Incidents are kept sorted by opening time, with their IDs by state and by
+    priority, and aggregates (open count, MTTR) updated on every write, so
+    queries and stats never call Elasticsearch. Like the incidents store, it
+    is rebuilt from Elasticsearch at startup and updated by our own writes.
+    """
+    def __init__(self):
+        self.by_id          = {}
+        self.keys           = []
+        self.by_state       = {state: set() for state in IncidentState}
+        self.by_priority    = {priority: set()
+                               for priority in IncidentPriority}
+        self.aggregates     = Aggregates()
+        # Writes made while rebuilding, replayed on the rebuilt index
+        self.pending        = None
+        self.lock           = threading.Lock()
+
+    def put(self, incident):
+        summary = IncidentSummary(incident)
+        with self.lock:
+            if self.pending is not None:
+                self.pending.append(summary)
+            self._put(summary)
+
+    def _put(self, summary):
+        previous = self.by_id.get(summary.id)
+        if previous is not None:
+            self.keys.pop(bisect.bisect_left(self.keys, previous.key))
+            self.by_state[previous.state].discard(previous.id)
+            self.by_priority[previous.priority].discard(previous.id)
+            self.aggregates.remove(previous)
+        self.by_id[summary.id] = summary
+        bisect.insort(self.keys, summary.key)
+        self.by_state[summary.state].add(summary.id)
+        self.by_priority[summary.priority].add(summary.id)
+        self.aggregates.add(summary)
+
+    def summaries(self):
+        with self.lock:
+            return list(self.by_id.values())
+
+    def get(self, incident_id):
+        with self.lock:
+            return self.by_id.get(incident_id)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.by_id)
+
+    def stats(self):
+        with self.lock:
+            return self.aggregates.to_dict()
+
+    def query(self, state=None, priority=None, opened_after=None,
+              opened_before=None, closed_after=None, closed_before=None,
+              limit=DEFAULT_LIMIT, cursor=None):
+        """
+        Incidents matching every given filter, most recently opened first
+
+        Returns at most `limit` incidents and the cursor of the next page,
+        None on the last one.
+        """
+        limit = min(max(1, limit), MAX_LIMIT)
+        with self.lock:
+            ids = None
+            if state is not None:
+                ids = self.by_state[state]
+            if priority is not None:
+                ids = self.by_priority[priority] if ids is None \
+                    else ids & self.by_priority[priority]
+            # Walk the keys from the newest one before the cursor, down to
+            # `opened_after`
+            end = len(self.keys)
+            if opened_before is not None:
+                end = bisect.bisect_left(self.keys,
+                                         (opened_before.timestamp(),))
+            if cursor is not None:
+                end = min(end, bisect.bisect_left(self.keys,
+                                                  decode_cursor(cursor)))
+            start = 0
+            if opened_after is not None:
+                start = bisect.bisect_left(self.keys,
+                                           (opened_after.timestamp(),))
+            incidents = []
+            idx = end - 1
+            while idx >= start and len(incidents) <= limit:
+                incident_id = self.keys[idx][1]
+                idx -= 1
+                if ids is not None and incident_id not in ids:
+                    continue
+                summary = self.by_id[incident_id]
+                if closed_after is not None or closed_before is not None:
+                    if summary.closing_time is None:
+                        continue
+                    if closed_after is not None and \
+                            summary.closing_time < closed_after:
+                        continue
+                    if closed_before is not None and \
+                            summary.closing_time >= closed_before:
+                        continue
+                incidents.append(summary)
+        # One more incident than asked tells there is a next page
+        next_cursor = None
+        if len(incidents) > limit:
+            incidents = incidents[:limit]
+            next_cursor = encode_cursor(incidents[-1].key)
+        return incidents, next_cursor
+
+    def rebuild(self, es, es_index):
+        """Load every incident from Elasticsearch, updates left out"""
+        log.info("Rebuilding incidents index from index %s ...", es_index)
+        with self.lock:
+            self.pending = []
+        try:
+            rebuilt = IncidentIndex()
+            for hit in helpers.scan(
+                    es,
+                    index = es_index,
+                    doc_type = "incident",
+                    query = {"query": {"match_all": {}},
+                             "_source": {"excludes": ["updates"]}}):
+                rebuilt._put(IncidentSummary(
+                    Incident().unserialize(hit['_source'])))
+            with self.lock:
+                for summary in self.pending:
+                    rebuilt._put(summary)
+                self.by_id          = rebuilt.by_id
+                self.keys           = rebuilt.keys
+                self.by_state       = rebuilt.by_state
+                self.by_priority    = rebuilt.by_priority
+                self.aggregates     = rebuilt.aggregates
+        finally:
+            with self.lock:
+                self.pending = None
+        log.info("... indexed %s incidents", len(self))
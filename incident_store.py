@@ -0,0 +1,95 @@
+import threading
+
+from elasticsearch import helpers
+
+from log import log
+import codec
+
+
+class IncidentStore(object):
+    """
+    In-process index of incidents by Slack channel ID
+
+    Elasticsearch stays the source of truth: the store is warmed from it at
+    startup, kept up to date on every write and only saves the search that
+    every channel command used to run.
+    """
+    def __init__(self):
+        self.by_channel = {}
+        self.lock       = threading.Lock()
+
+    def put(self, incident):
+        if incident.slack_channel_id is None:
+            return
+        with self.lock:
+            self.by_channel[incident.slack_channel_id] = incident
+
+    def get_by_channel(self, channel_id):
+        with self.lock:
+            return self.by_channel.get(channel_id)
+
+    def incidents(self):
+        with self.lock:
+            return list(self.by_channel.values())
+
+    def __len__(self):
+        with self.lock:
+            return len(self.by_channel)
+
+    def put_if_newer(self, incident):
+        """
+        Put an incident loaded from Elasticsearch, unless the store has a
+        more recently written version of it
+
+        Returns whether it was put.
+        """
+        if incident.slack_channel_id is None:
+            return False
+        with self.lock:
+            current = self.by_channel.get(incident.slack_channel_id)
+            if current is not None and current.updated_time is not None and \
+                    (incident.updated_time is None or
+                     current.updated_time > incident.updated_time):
+                return False
+            self.by_channel[incident.slack_channel_id] = incident
+            return True
+
+    def warm(self, es, es_index, manager):
+        """
+        Load every incident having a Slack channel from Elasticsearch
+
+        Incidents written by commands running meanwhile, whose writes may
+        not be flushed yet, are kept.
+        """
+        from incident import Incident
+        log.info("Warming incidents store from index %s ...", es_index)
+        for hit in helpers.scan(
+                es,
+                index = es_index,
+                doc_type = "incident",
+                query = {"query": {"exists": {"field": "slack_channel_id"}}}):
+            self.put_if_newer(Incident(manager=manager).unserialize(
+                hit['_source']))
+        log.info("... loaded %s incidents", len(self))
+
+    def catch_up(self, es, es_index, manager, since):
+        """
+        Load the incidents written since `since` from Elasticsearch, unless
+        the store has a newer version of them
+
+        Returns the incidents loaded.
+        """
+        from incident import Incident
+        log.info("Catching up on incidents written since %s ...", since)
+        loaded = []
+        for hit in helpers.scan(
+                es,
+                index = es_index,
+                doc_type = "incident",
+                query = {"query": {"range": {"updated_time": {
+                    "gte": codec.encode_date(since)}}}}):
+            incident = Incident(manager=manager).unserialize(hit['_source'])
+            if self.put_if_newer(incident):
+                loaded.append(incident)
+        log.info("... caught up on %s incidents", len(loaded))
+        return loaded
@@ -1,10 +1,18 @@
+from contextlib import contextmanager
+from datetime import datetime
+import json
+import threading
+import time
+import weakref
+
 # Slack
 from slacker import Slacker
 from slacker import Error as SlackerError
 # JIRA
 from jira import JIRA
+from jira.exceptions import JIRAError
 # ElasticSearch
-from elasticsearch import Elasticsearch, RequestsHttpConnection
+from elasticsearch import Elasticsearch
 from aws_requests_auth.aws_auth import AWSRequestsAuth
 from aws_requests_auth import boto_utils
 # Cachet
@@ -12,123 +20,699 @@ import cachetclient.cachet as cachet
 
 from log import log
 from config import config
-from incident import Incident
+from connections import pools, PooledRequestsHttpConnection
+from cache import TTLCache
+from slack_transport import SlackSession, PRIORITY_HIGH, PRIORITY_LOW
+from slack_templates import SlackTemplates
+from incident import Incident, IncidentState, JIRA_BROWSE_URL
+from incident_store import IncidentStore
+from incident_index import IncidentIndex
+from channel_directory import ChannelDirectory
+from es_writer import EsWriter
+from plan import ExecutionPlan
+from batching import Batcher
+from resilience import resilience, PermanentError
+from backends import Backend, BackendState
+from outbox import Outbox
+from cachet_sync import CachetSync, desired_state
+from snapshot import SnapshotFile
+import codec
+
+
+# Other processes' clocks may be late: catch up on some more writes
+CATCH_UP_MARGIN = 60
+# Seconds between warmup attempts of the store and index, doubling
+WARMUP_BACKOFF      = 1
+WARMUP_MAX_BACKOFF  = 300
+
+
+@contextmanager
+def jira_errors():
+    """Jira client errors won't go away with retries"""
+    try:
+        yield
+    except JIRAError as e:
+        if e.status_code is not None and 400 <= e.status_code < 500 and \
+                e.status_code != 429:
+            raise PermanentError(str(e))
+        raise
 
 
 class IncidentsManager(object):
     def __init__(self):
+        """
+        Set the manager up without calling any backend
+
+        Clients are connected on first use, or ahead of time by `warmup`.
+        """
         log.info("Initializing incidents manager ...")
         # Slack
         self.slack_channel = config['slack']['channel']
-        self.slack = Slacker(config['slack']['self']['token'])
+        # Both Slack clients share one rate-limit-aware, pooled session
+        self.slack_session = pools.mount(SlackSession(
+            limits=config['slack'].get('rate_limits'),
+            max_retries=config['slack'].get('max_retries', 5)), 'slack')
+        self.slack = Slacker(config['slack']['self']['token'],
+                             session=self.slack_session)
         self.slack_self_user = config['slack']['self']
-        self.slack_fake_user = Slacker(config['slack']['fake_user']['token'])
-        self.apiai_user = self.slack_fake_user.users.info(
-            user=config['slack']['apiai_user']['id']).body['user']
+        self.slack_fake_user = Slacker(config['slack']['fake_user']['token'],
+                                       session=self.slack_session)
+        # Messages layouts are compiled once
+        self.templates = SlackTemplates(config['slack'].get('templates'))
+        self.slack_channels = ChannelDirectory(
+            self.slack,
+            page_size=config['slack'].get('channels_page_size', 1000))
+        # Channels and users barely change while an incident is open
+        cache_config = config['slack'].get('cache', {})
+        self.slack_channels_cache = TTLCache(
+            'slack_channels',
+            size=cache_config.get('size', 1000),
+            ttl=cache_config.get('ttl', 300))
+        self.slack_users_cache = TTLCache(
+            'slack_users',
+            size=cache_config.get('size', 1000),
+            ttl=cache_config.get('ttl', 300))
         # FIXME SMTP
         # Elasticsearch
-        log.info("Connecting to Elasticsearch ...")
         self.es_index = config['elasticsearch']['index']
-        try:
-            # @formatter:off
-            aws_auth = AWSRequestsAuth(
-                aws_host    = config['elasticsearch']['host'],
-                aws_region  = config['elasticsearch']['region'],
-                aws_service = 'es',
-                **boto_utils.get_credentials()
-            )
-            self.es = Elasticsearch(
-                hosts   = [{'host': config['elasticsearch']['host'],
-                            'port': 443}],
-                http_auth           = aws_auth,
-                use_ssl             = True,
-                verify_certs        = True,
-                connection_class    = RequestsHttpConnection
-            )
-            # @formatter:on
-        except:
-            log.error("Couldn't connect to Elasticsearch")
-        try:
-            self.create_es_index(self.es_index)
-        except:
-            log.error("Couldn't create Elasticsearch index")
+        self.store = IncidentStore()
+        # With several server processes, the store is only trusted to map
+        # channels to incident IDs
+        self.shared_state = config.get('server', {}).get('workers', 1) > 1
+        self.incident_locks = weakref.WeakValueDictionary()
+        self.incident_locks_lock = threading.Lock()
+        # Without warmup, the store and index only hold our own writes
+        initial_state = BackendState.PENDING if config.get('warmup', True) \
+            else BackendState.DISABLED
+        self.store_state = initial_state
+        # Every incident, for queries and stats
+        self.index = IncidentIndex()
+        self.index_state = initial_state
+        self.index_refresh_interval = config.get('incidents_index', {}).get(
+            'refresh_interval', 0)
+        self.es_writer = EsWriter(
+            lambda: self.es, self.es_index,
+            batch_size=config['elasticsearch'].get('bulk_size', 100),
+            flush_interval=config['elasticsearch'].get('flush_interval', 1.0))
+        self.es_writer.start()
         # Jira
-        log.info("Connecting to Jira ...")
-        self.jira = JIRA(
-            {'server': config['jira']['host']},
-            basic_auth=(config['jira']['user'], config['jira']['password'])
-        )
         self.jira_project = config['jira']['project']
-        log.debug("Connecting to Cachet ...")
-        self.cachet_client = cachet.Incidents(endpoint=config['cachet']['host'],
-                                              api_token=config['cachet']['token'])
+        self.backends = {
+            'slack': Backend('slack', self.connect_slack),
+            'elasticsearch': Backend('elasticsearch',
+                                     self.connect_elasticsearch),
+            'jira': Backend('jira', self.connect_jira),
+            'cachet': Backend('cachet', self.connect_cachet)
+        }
+        # Cachet and Jira side effects that can wait run from the outbox
+        outbox_config = config.get('outbox', {})
+        self.outbox = Outbox(
+            outbox_config.get('path', 'outbox.sqlite'),
+            backoff=outbox_config.get('backoff', 1.0),
+            max_backoff=outbox_config.get('max_backoff', 300.0),
+            max_attempts=outbox_config.get('max_attempts', 50))
+        self.outbox.register('cachet', 'incidents.sync',
+                             self.sync_cachet_incident)
+        self.cachet_sync = CachetSync()
+        # Changes within this delay are synced to Cachet at once
+        self.cachet_debounce = config['cachet'].get('debounce', 5.0)
+        self.outbox.register('jira', 'transition_issue',
+                             self.transition_jira_issue)
+        self.outbox.register('jira', 'add_comment', self.comment_jira_issue)
+        self.outbox.register('jira', 'create_issue', self.attach_jira_issue)
+        self.outbox.start()
+        # Creates arriving within `window` seconds are handled together
+        batching_config = config.get('incident_batching', {})
+        self.create_batcher = None
+        if batching_config.get('window', 0) > 0:
+            self.create_batcher = Batcher(
+                'incidents creation', self.create_incidents,
+                window=batching_config['window'],
+                max_size=batching_config.get('max_size', 20))
+        # Local state is saved regularly, so that restarts start warm
+        snapshot_config = config.get('snapshot', {})
+        self.snapshot = None
+        self.snapshot_time = None
+        if snapshot_config.get('path'):
+            self.snapshot = SnapshotFile(
+                snapshot_config['path'], self.collect_snapshot,
+                interval=snapshot_config.get('interval', 60))
+            self.restore_snapshot(self.snapshot.load())
+            self.snapshot.start()
         return
 
+    @property
+    def apiai_user(self):
+        return self.backends['slack'].get()
+
+    @property
+    def es(self):
+        return self.backends['elasticsearch'].get()
+
+    @property
+    def jira(self):
+        return self.backends['jira'].get()
+
+    @property
+    def cachet_client(self):
+        return self.backends['cachet'].get()
+
+    def connect_slack(self):
+        """Check Slack access, fetching the Dialogflow user on the way"""
+        with resilience.guard('slack', 'users.info'):
+            return self.slack_fake_user.users.info(
+                user=config['slack']['apiai_user']['id']).body['user']
+
+    def connect_elasticsearch(self):
+        # @formatter:off
+        aws_auth = AWSRequestsAuth(
+            aws_host    = config['elasticsearch']['host'],
+            aws_region  = config['elasticsearch']['region'],
+            aws_service = 'es',
+            **boto_utils.get_credentials()
+        )
+        es = Elasticsearch(
+            hosts   = [{'host': config['elasticsearch']['host'],
+                        'port': 443}],
+            http_auth           = aws_auth,
+            use_ssl             = True,
+            verify_certs        = True,
+            connection_class    = PooledRequestsHttpConnection,
+            timeout             = pools.timeout('elasticsearch')
+        )
+        # @formatter:on
+        self.create_es_index(es, self.es_index)
+        return es
+
+    def connect_jira(self):
+        with resilience.guard('jira', 'connect'):
+            jira = JIRA(
+                {'server': config['jira']['host']},
+                basic_auth=(config['jira']['user'], config['jira']['password']),
+                timeout=pools.timeout('jira')
+            )
+        pools.mount(jira._session, 'jira')
+        return jira
+
+    def connect_cachet(self):
+        cachet_client = cachet.Incidents(endpoint=config['cachet']['host'],
+                                         api_token=config['cachet']['token'],
+                                         timeout=pools.timeout('cachet'))
+        pools.mount(cachet_client.http, 'cachet')
+        return cachet_client
+
+    def queue_cachet_sync(self, incidents):
+        """Sync incidents, declared together, to Cachet after the debounce"""
+        # Incidents declared together share the Cachet incident created by
+        # their first sync, which doesn't tell which ones: syncs stay in order
+        self.outbox.enqueue('cachet', 'incidents.sync', {
+            'incidents': [{'incident_id': incident.id,
+                           'slack_channel_id': incident.slack_channel_id}
+                          for incident in incidents]
+        }, delay=self.cachet_debounce, key='cachet')
+
+    def sync_cachet_incident(self, payload):
+        """
+        Outbox handler: bring the Cachet incident of one or several incidents
+        up to date
+
+        Their Cachet incident is created on the first sync, then only the
+        fields that changed since the last sync are updated: several
+        changes queued within the debounce delay are synced by the first
+        entry, and the next ones find nothing to do.
+        """
+        # Incidents whose channel couldn't be created can't be found
+        incidents = [self.get_incident_from_channel(target['slack_channel_id'])
+                     for target in payload['incidents']
+                     if target['slack_channel_id'] is not None]
+        incidents = [incident for incident in incidents
+                     if incident is not None]
+        if not incidents:
+            log.warning("No incident left to sync to Cachet")
+            return
+        cachet_id = incidents[0].cachet_id
+        if cachet_id is None:
+            self.post_cachet_incident({
+                'incidents': payload['incidents'],
+                'incident': desired_state(incidents)
+            })
+            return
+        # Incidents declared together share their Cachet incident
+        ids = {incident.id for incident in incidents}
+        incidents += [incident for incident in self.store.incidents()
+                      if incident.cachet_id == cachet_id and
+                      incident.id not in ids]
+        incidents.sort(key=lambda incident: incident.id)
+        changes = self.cachet_sync.changes(cachet_id, desired_state(incidents))
+        if not changes:
+            log.debug("Cachet incident %s already up to date", cachet_id)
+            return
+        log.info("Updating %s of Cachet incident %s", sorted(changes),
+                 cachet_id)
+        with resilience.guard('cachet', 'incidents.put'):
+            self.cachet_client.put(id=cachet_id, **changes)
+        self.cachet_sync.synced_as(cachet_id, changes)
+
+    def post_cachet_incident(self, payload):
+        """Declare one or several incidents to Cachet, and keep its ID"""
+        with resilience.guard('cachet', 'incidents.post'):
+            new_cachet_incident = json.loads(
+                self.cachet_client.post(**payload['incident']))
+        cachet_id = new_cachet_incident['data']['id']
+        self.cachet_sync.synced_as(cachet_id, payload['incident'])
+        for target in payload['incidents']:
+            channel_id = target['slack_channel_id']
+            with self.incident_lock(channel_id):
+                incident = self.store.get_by_channel(channel_id)
+                if incident is not None:
+                    incident.cachet_id = cachet_id
+                    incident.updated_time = datetime.now()
+                    self.index.put(incident)
+                # Other processes read it from Elasticsearch before syncing
+                self.es_writer.update(target['incident_id'], codec.dumps({
+                    'cachet_id': cachet_id,
+                    'updated_time': codec.encode_date(datetime.now())
+                }), wait=self.shared_state)
+
+    def create_jira_issue(self, title, description):
+        with resilience.guard('jira', 'create_issue'), jira_errors():
+            return str(self.jira.create_issue(
+                project     = self.jira_project,
+                issuetype   = {'name': 'Incident'},
+                summary     = title,
+                description = description))
+
+    def queue_jira_issue(self, incident):
+        """Create the Jira issue of an incident once Jira is back"""
+        self.outbox.enqueue('jira', 'create_issue', {
+            'incident_id': incident.id,
+            'slack_channel_id': incident.slack_channel_id,
+            'title': incident.title,
+            'description': incident.description
+        }, key=incident.slack_channel_id)
+
+    def attach_jira_issue(self, payload):
+        """
+        Outbox handler: create the Jira issue of an existing incident
+
+        The issue key is saved before anything else, and a retry finding it
+        doesn't create another issue.
+        """
+        channel_id = payload['slack_channel_id']
+        incident = self.get_incident_from_channel(channel_id)
+        if incident is not None and incident.jira_issue is not None:
+            log.info("Incident %s already has Jira issue %s",
+                     payload['incident_id'], incident.jira_issue)
+            return
+        jira_issue = self.create_jira_issue(payload['title'],
+                                            payload['description'])
+        with self.incident_lock(channel_id):
+            incident = self.store.get_by_channel(channel_id)
+            if incident is not None:
+                incident.jira_issue = jira_issue
+                incident.updated_time = datetime.now()
+                self.index.put(incident)
+            self.es_writer.update(payload['incident_id'], codec.dumps({
+                'jira_issue': jira_issue,
+                'updated_time': codec.encode_date(datetime.now())
+            }), wait=True)
+        log.info("Attached Jira issue %s to incident %s", jira_issue,
+                 payload['incident_id'])
+        # Best effort: failing here would retry the entry, not the message
+        try:
+            with resilience.guard('slack', 'chat.postMessage'):
+                self.slack.chat.post_message(
+                    channel=channel_id,
+                    text="Jira is back, this incident now has its issue: " +
+                         JIRA_BROWSE_URL + jira_issue + "|" + jira_issue + ">",
+                    as_user=True)
+        except Exception:
+            log.warning("Couldn't announce Jira issue %s in %s", jira_issue,
+                        channel_id, exc_info=True)
+
+    def jira_issue_of(self, payload):
+        """Jira issue of a side effect queued before the issue existed"""
+        if payload.get('issue'):
+            return payload['issue']
+        incident = self.get_incident_from_channel(payload['slack_channel_id'])
+        if incident is None or incident.jira_issue is None:
+            raise Exception("Jira issue not created yet")
+        return incident.jira_issue
+
+    def transition_jira_issue(self, payload):
+        """Outbox handler"""
+        jira_issue = self.jira_issue_of(payload)
+        with resilience.guard('jira', 'transition_issue'), jira_errors():
+            self.jira.transition_issue(jira_issue, payload['transition'])
+
+    def comment_jira_issue(self, payload):
+        """Outbox handler"""
+        jira_issue = self.jira_issue_of(payload)
+        with resilience.guard('jira', 'add_comment'), jira_errors():
+            self.jira.add_comment(jira_issue, payload['body'])
+
+    def warmup(self):
+        """Connect to every backend and warm the incidents store"""
+        log.info("Warming up incidents manager ...")
+        for backend in self.backends.values():
+            backend.warmup()
+        if self.snapshot_time is None or not self.catch_up():
+            self.warm_until_ready()
+        if self.index_refresh_interval > 0:
+            threading.Thread(target=self.refresh_index, name="index-refresh",
+                             daemon=True).start()
+        log.info("... warmed up")
+
+    def warm_until_ready(self):
+        """
+        Warm the store and rebuild the index, retrying with a backoff until
+        both worked, e.g. when Elasticsearch is down at startup
+        """
+        delay = WARMUP_BACKOFF
+        while True:
+            if self.store_state != BackendState.READY:
+                self.warm_store()
+            if self.index_state != BackendState.READY:
+                self.rebuild_index()
+            if self.store_state == BackendState.READY and \
+                    self.index_state == BackendState.READY:
+                return
+            log.warning("Incidents store or index not warmed up, retrying "
+                        "in %ss", delay)
+            time.sleep(delay)
+            delay = min(WARMUP_MAX_BACKOFF, delay * 2)
+
+    def warm_store(self):
+        # noinspection PyBroadException
+        try:
+            with resilience.guard('elasticsearch', 'scan'):
+                self.store.warm(self.es, self.es_index, self)
+            for incident in self.store.incidents():
+                self.slack_channels.add({'id': incident.slack_channel_id,
+                                         'name': incident.slack_channel})
+            self.store_state = BackendState.READY
+        except Exception:
+            self.store_state = BackendState.FAILED
+            log.exception("Couldn't warm incidents store, falling back to "
+                      "Elasticsearch searches until it is")
+
+    def catch_up(self):
+        """
+        Complete the state restored from the snapshot with the incidents
+        written since, instead of loading every incident
+
+        Returns whether it worked.
+        """
+        since = datetime.fromtimestamp(self.snapshot_time - CATCH_UP_MARGIN)
+        # noinspection PyBroadException
+        try:
+            with resilience.guard('elasticsearch', 'scan'):
+                loaded = self.store.catch_up(self.es, self.es_index, self,
+                                             since)
+        except Exception:
+            log.exception("Couldn't catch up on the incidents written since "
+                          "the snapshot, loading all of them")
+            return False
+        for incident in loaded:
+            self.index.put(incident)
+            if incident.slack_channel_id is not None:
+                self.slack_channels.add({'id': incident.slack_channel_id,
+                                         'name': incident.slack_channel})
+        self.store_state = BackendState.READY
+        self.index_state = BackendState.READY
+        return True
+
+    def collect_snapshot(self):
+        """
+        State to save in snapshots: ongoing incidents, the index, and the
+        Slack channels and caches
+
+        Nothing is saved until the store and the index are complete: the
+        incidents they miss would never be caught up on.
+        """
+        if self.store_state != BackendState.READY or \
+                self.index_state != BackendState.READY:
+            return None
+        return {
+            'incidents': [Incident.SCHEMA.to_dict(incident)
+                          for incident in self.store.incidents()
+                          if incident.state == IncidentState.ONGOING],
+            'index': [summary.to_dict()
+                      for summary in self.index.summaries()],
+            'channels': self.slack_channels.channels(),
+            'caches': {cache.name: cache.dump()
+                       for cache in (self.slack_channels_cache,
+                                     self.slack_users_cache)}
+        }
+
+    def restore_snapshot(self, state):
+        """Fill the store, index, channels and caches from a snapshot"""
+        if state is None:
+            return
+        elapsed = max(0, time.time() - state['time'])
+        for source in state['incidents']:
+            self.store.put(Incident(manager=self).unserialize(source))
+        for source in state['index']:
+            self.index.put(Incident().unserialize(source))
+        for channel in state['channels']:
+            self.slack_channels.add(channel)
+        for cache in (self.slack_channels_cache, self.slack_users_cache):
+            cache.load(state['caches'].get(cache.name, []), elapsed)
+        self.snapshot_time = state['time']
+        log.info("... restored %s ongoing incidents and %s indexed incidents "
+                 "from a %.0fs old snapshot", len(state['incidents']),
+                 len(state['index']), elapsed)
+
+    def rebuild_index(self):
+        # noinspection PyBroadException
+        try:
+            with resilience.guard('elasticsearch', 'scan'):
+                self.index.rebuild(self.es, self.es_index)
+            self.index_state = BackendState.READY
+        except Exception:
+            if self.index_state != BackendState.READY:
+                self.index_state = BackendState.FAILED
+            log.exception("Couldn't rebuild incidents index")
+
+    def refresh_index(self):
+        """Rebuild the index periodically, to see other processes' writes"""
+        while True:
+            time.sleep(self.index_refresh_interval)
+            self.rebuild_index()
+
+    def start_warmup(self):
+        threading.Thread(target=self.warmup, name="warmup",
+                         daemon=True).start()
+
+    def readiness(self):
+        """State of each backend, and of the incidents store"""
+        status = {name: backend.status()
+                  for name, backend in self.backends.items()}
+        status['incidents_store'] = {'state': self.store_state.value,
+                                     'error': None}
+        status['incidents_index'] = {'state': self.index_state.value,
+                                     'error': None}
+        return status
+
     def create_incident(self, priority, title, description):
-        log.info("Starting to create incident ...")
-        log.info("Declaring incident to Jira ...")
         if not priority:
             priority = "red"
         if not title:
             title = "Undefined"
         if not description:
             description = "Undefined"
-        jira_issue = self.jira.create_issue(
-            project     = self.jira_project,
-            issuetype   = {'name': 'Incident'},
-            summary     = title,
-            description = description)
-        incident_id = int(str(jira_issue)[len(self.jira_project)+1:])
-        log.debug("Got incident id " + str(incident_id) + " from Jira")
-        incident = Incident(
-            incident_id,
-            priority    = priority,
-            title       = title,
-            description = description)
-        incident.send_to_es()
-        # log.debug(incident.serialize())
-        self.create_slack_channel(incident)
-        # Resend it now that is has a Slack channel ID
-        incident.send_to_es()
-        self.post_new_incident_announce_on_slack(incident)
-        self.post_new_incident_summary(incident)
+        request = (priority, title, description)
+        if self.create_batcher is not None:
+            # Creates arriving together, e.g. on a large outage, are batched
+            return self.create_batcher.submit(request)
+        incident = self.create_incidents([request])[0]
+        if isinstance(incident, Exception):
+            raise incident
+        return incident
+
+    def create_jira_issues(self, requests):
+        """
+        Jira issue of each (priority, title, description) request, in a
+        single bulk call when there are several of them, None for the issues
+        that couldn't be created
+        """
+        # noinspection PyBroadException
+        try:
+            if len(requests) == 1:
+                _, title, description = requests[0]
+                return [self.create_jira_issue(title, description)]
+            with resilience.guard('jira', 'create_issues'), jira_errors():
+                results = self.jira.create_issues(field_list=[
+                    {
+                        'project': {'key': self.jira_project},
+                        'issuetype': {'name': 'Incident'},
+                        'summary': title,
+                        'description': description
+                    } for _, title, description in requests
+                ], prefetch=False)
+        except Exception:
+            log.warning("Couldn't create Jira issues", exc_info=True)
+            return [None] * len(requests)
+        jira_issues = []
+        for result in results:
+            if result['status'] == 'Success':
+                jira_issues.append(result['issue'].key)
+            else:
+                log.warning("Couldn't create Jira issue %s: %s",
+                            result['input_fields']['summary'],
+                            result['error'])
+                jira_issues.append(None)
+        return jira_issues
+
+    def create_incidents(self, requests):
+        """
+        Create incidents from (priority, title, description) requests
+
+        Each incident gets its own Jira issue and Slack channel, but Jira
+        issues are created in bulk, the new incidents are announced in a
+        single message, declared to Cachet as one incident and made
+        searchable with a single Elasticsearch refresh. Returns each
+        incident, or the error that made its creation fail.
+        """
+        log.info("Starting to create %s incidents ...", len(requests))
+        log.info("Declaring incidents to Jira ...")
+        jira_issues = self.create_jira_issues(requests)
+        incidents = []
+        for idx, ((priority, title, description), jira_issue) in \
+                enumerate(zip(requests, jira_issues)):
+            if jira_issue is not None:
+                incident_id = int(jira_issue[len(self.jira_project)+1:])
+                log.debug("Got incident id %s from Jira", incident_id)
+            else:
+                # Degraded mode: the incident is handled without waiting for
+                # Jira, and gets its issue once Jira is back
+                incident_id = int(time.time() * 1000) + idx
+                log.warning("Using provisional incident id %s", incident_id)
+            incident = Incident(
+                incident_id,
+                priority    = priority,
+                title       = title,
+                description = description,
+                manager     = self)
+            incident.jira_issue = jira_issue
+            incidents.append(incident)
+        # Everything below only needs the incident ID and, for most of it,
+        # the Slack channel ID: run independent calls concurrently
+        plan = ExecutionPlan("create incidents " + ", ".join(
+            str(incident.id) for incident in incidents))
+        for incident in incidents:
+            self.plan_incident_creation(plan, incident)
+        steps = [str(incident.id) + "." + step for incident in incidents
+                 for step in ('es_initial', 'slack_channel')]
+        # Steps for all the incidents wait for every channel, created or not.
+        # Resend them now that they have a Slack channel ID, and make sure
+        # they can be searched by channel right away
+        plan.add('es_final', self.index_new_incidents, incidents, after=steps)
+        plan.add('slack_announce', self.announce_new_incidents, incidents,
+                 after=steps)
         # FIXME send email
-        incident.declare_to_cachet()
-        log.info("Created incident successfully :)")
+        plan.add('cachet', self.queue_cachet_sync, incidents, after=steps)
+        # noinspection PyBroadException
+        try:
+            plan.run()
+        except Exception:
+            pass
+        results = []
+        for incident in incidents:
+            prefix = str(incident.id) + "."
+            errors = [error for step, error in plan.errors.items()
+                      if step.startswith(prefix) or '.' not in step]
+            results.append(errors[0] if errors else incident)
+        log.info("Created %s incidents :)",
+                 sum(not isinstance(result, Exception)
+                     for result in results))
+        return results
+
+    def plan_incident_creation(self, plan, incident):
+        """Add the steps of a single incident creation to a plan"""
+        prefix = str(incident.id) + "."
+        plan.add(prefix + 'es_initial', incident.send_to_es)
+        plan.add(prefix + 'slack_channel', self.create_slack_channel,
+                 incident)
+        if incident.jira_issue is None:
+            plan.add(prefix + 'jira', self.queue_jira_issue, incident,
+                     depends_on=[prefix + 'slack_channel'])
+        plan.add(prefix + 'slack_join', self.join_slack_channel, incident,
+                 depends_on=[prefix + 'slack_channel'])
+        # Dialogflow user
+        plan.add(prefix + 'slack_invite_apiai',
+                 self.invite_apiai_user_to_incident_channel, incident,
+                 depends_on=[prefix + 'slack_join'])
+        # App user
+        plan.add(prefix + 'slack_invite_self',
+                 self.invite_user_to_incident_channel, self.slack_self_user,
+                 incident, depends_on=[prefix + 'slack_join'])
+        plan.add(prefix + 'slack_purpose', self.set_slack_channel_purpose,
+                 incident, depends_on=[prefix + 'slack_invite_self'])
+        plan.add(prefix + 'slack_topic', self.set_slack_channel_topic,
+                 incident, depends_on=[prefix + 'slack_invite_self'])
+        plan.add(prefix + 'slack_summary', self.post_new_incident_summary,
+                 incident, depends_on=[prefix + 'slack_invite_self'])
+
+    def index_new_incidents(self, incidents):
+        """
+        Make new incidents searchable right away, unless Elasticsearch is
+        down: their writes then stay buffered until they succeed
+        """
+        # noinspection PyBroadException
+        try:
+            for incident in incidents:
+                incident.send_to_es()
+            self.es_writer.flush(refresh='wait_for')
+        except Exception:
+            log.warning("Couldn't index incidents %s yet, they will be "
+                        "retried", [incident.id for incident in incidents],
+                        exc_info=True)
 
     def close_incident(self, event):
         log.info("Closing incident ...")
         source = self.extract_event_infos(event)
         # log.debug("Source: " + str(source))
-        incident_json = self.find_incident_from_channel(source['channel']['id'])
-        incident = Incident().unserialize(incident_json)
-        incident.close()
+        with self.locked_incident(source['channel']['id']) as incident:
+            if incident is None:
+                return
+            incident.close()
         log.info("Closed incident successfully :)")
 
-    def list_incident_updates(self, event):
+    def list_incident_updates(self, parameters, event):
         log.info("Listing incident updates ...")
         source = self.extract_event_infos(event)
-        incident_json = self.find_incident_from_channel(source['channel']['id'])
-        incident = Incident().unserialize(incident_json)
-        incident.list_updates()
+        # Optional "last N updates" or "updates N to M" (1-based, included)
+        last = parameters.get('number')
+        start = parameters.get('from')
+        end = parameters.get('to')
+        with self.locked_incident(source['channel']['id']) as incident:
+            if incident is None:
+                return
+            incident.list_updates(
+                start = int(start) - 1 if start else None,
+                end = int(end) if end else None,
+                last = int(last) if last else None)
         log.info("Listed incident updates with success")
 
     def set_incident_description(self, parameters, event):
         log.info("Setting incident description ...")
         source = self.extract_event_infos(event)
-        incident_json = self.find_incident_from_channel(source['channel']['id'])
-        incident = Incident().unserialize(incident_json)
-        incident.set_description(parameters['description'])
+        with self.locked_incident(source['channel']['id']) as incident:
+            if incident is None:
+                return
+            incident.set_description(parameters['description'])
         log.info("Set incident description with success")
 
     def log_update(self, parameters, event):
         log.info("Logging new update ...")
         source = self.extract_event_infos(event)
-        log.debug("--- Channel: " + str(source['channel']['name']))
-        log.debug("--- User: " + str(source['user']['name']))
-        incident_json = self.find_incident_from_channel(source['channel']['id'])
-        incident = Incident().unserialize(incident_json)
-        incident.add_update(parameters['description'], source['user'])
+        log.debug("--- Channel: %s", source['channel']['name'])
+        log.debug("--- User: %s", source['user']['name'])
+        with self.locked_incident(source['channel']['id']) as incident:
+            if incident is None:
+                return
+            incident.add_update(parameters['description'], source['user'])
         log.info("Logged new update with success")
 
     def extract_event_infos(self, event):
@@ -137,175 +721,239 @@ class IncidentsManager(object):
         source_user_id = event['user']
         source_message = event['text']
 
-        # Get real infos from Slack API
-        source_channel = self.slack.channels.info(channel=source_channel_id).body['channel']
-        source_user = self.slack.users.info(user=source_user_id).body['user']
+        # Get real infos from Slack API, unless already cached
+        source_channel = self.slack_channels_cache.get_or_load(
+            source_channel_id, self.get_slack_channel_info)
+        source_user = self.slack_users_cache.get_or_load(
+            source_user_id, self.get_slack_user_info)
         return {
             'channel': source_channel,
             'user': source_user,
             'message': source_message
         }
 
-    def create_es_index(self, es_index):
+    def get_slack_channel_info(self, channel_id):
+        with resilience.guard('slack', 'channels.info'):
+            return self.slack.channels.info(channel=channel_id).body['channel']
+
+    def get_slack_user_info(self, user_id):
+        with resilience.guard('slack', 'users.info'):
+            return self.slack.users.info(user=user_id).body['user']
+
+    def invalidate_slack_channel(self, channel_id):
+        """Forget cached channel infos, after we changed them ourselves"""
+        self.slack_channels_cache.invalidate(channel_id)
+
+    @staticmethod
+    def create_es_index(es, es_index):
         # === Wipe index
-        # self.es.indices.delete(index=self.es_index)
+        # es.indices.delete(index=es_index)
         # === Create it again
-        log.info("Creating index " + es_index + " ...")
-        index_creation = self.es.indices.create(index=es_index, ignore=400)
+        log.info("Creating index %s ...", es_index)
+        with resilience.guard('elasticsearch', 'indices.create'):
+            index_creation = es.indices.create(index=es_index, ignore=400)
         if 'acknowledged' in index_creation and index_creation['acknowledged']:
             log.info("... Index created")
         elif 'status' in index_creation and index_creation['status'] == 400:
             log.info("... Index already exists, continuing")
 
     def invite_user_to_channel(self, user, user_id, channel, channel_id):
-        log.debug("Inviting user {user} to new Slack channel {channel} ..."
-                  .format(user=user, channel=channel))
+        log.debug("Inviting user %s to new Slack channel %s ...", user,
+                  channel)
         try:
-            self.slack_fake_user.channels.invite(
-                channel = channel_id,
-                user = user_id
-            )
+            with resilience.guard('slack', 'channels.invite'):
+                self.slack_fake_user.channels.invite(
+                    channel = channel_id,
+                    user = user_id
+                )
         except SlackerError as e:
             if str(e) == "already_in_channel":
-                log.debug("User {user} already in channel {channel} ; continuing ..."
-                          .format(user=user, channel=channel))
+                log.debug("User %s already in channel %s ; continuing ...",
+                          user, channel)
                 pass
 
     # TODO : set channel topic and description
     def create_slack_channel(self, incident):
         # Create channel
-        log.info("Creating Slack channel " + incident.slack_channel + "...")
+        log.info("Creating Slack channel %s ...", incident.slack_channel)
         try:
-            channel = self.slack_fake_user.channels.create(
-                name=incident.slack_channel).body['channel']
-            log.debug("... created Slack channel with ID " + channel['id'])
+            with resilience.guard('slack', 'channels.create'):
+                channel = self.slack_fake_user.channels.create(
+                    name=incident.slack_channel).body['channel']
+            log.debug("... created Slack channel with ID %s", channel['id'])
         except SlackerError as e:
             if str(e) == "name_taken":
                 log.debug("... channel already exists, searching the existing one")
-                channels_list = self.slack.channels.list().body['channels']
-                channel = [chan for chan in channels_list if chan['name'] == incident.slack_channel]
-                if len(channel) != 1:
+                channel = self.slack_channels.lookup(incident.slack_channel)
+                if channel is None:
                     raise Exception("Failed to lookup channel that should exist")
-                channel = channel[0]
-                log.debug("... existing channel found,  continuing using channel " + channel['id'])
+                log.debug("... existing channel found,  continuing using channel %s",
+                          channel['id'])
                 pass
             else:
                 raise e
+        self.slack_channels.add(channel)
         incident.slack_channel_id = channel['id']
 
-        # Join channel
+    def join_slack_channel(self, incident):
         log.debug("Fake user joining channel ...")
-        self.slack_fake_user.channels.join(name=channel['name'])
+        with resilience.guard('slack', 'channels.join'):
+            self.slack_fake_user.channels.join(name=incident.slack_channel)
         log.debug("... joined channel")
 
-        # Invite Dialogflow user
-        log.debug("Inviting Dialogflow user to incident channel ...")
+    def invite_user_to_incident_channel(self, user, incident):
         self.invite_user_to_channel(
-            user=self.apiai_user['name'],
-            user_id=self.apiai_user['id'],
+            user=user['name'],
+            user_id=user['id'],
             channel=incident.slack_channel,
             channel_id=incident.slack_channel_id
         )
-        log.debug("Invited user")
+        log.debug("Invited user %s", user['name'])
 
-        # Invite App user
-        log.debug("Inviting self (app) user to incident channel ...")
-        self.invite_user_to_channel(
-            user=self.slack_self_user['name'],
-            user_id=self.slack_self_user['id'],
-            channel=incident.slack_channel,
-            channel_id=incident.slack_channel_id
-        )
-        log.debug("Invited user")
+    def invite_apiai_user_to_incident_channel(self, incident):
+        # Connecting to Slack fetches the user: only a step of the plan fails
+        # if it can't
+        self.invite_user_to_incident_channel(self.apiai_user, incident)
 
-        # Define purpose and title
+    def set_slack_channel_purpose(self, incident):
         log.debug("... defining channel purpose")
-        self.slack.channels.set_purpose(
-            channel = incident.slack_channel_id,
-            purpose = "Incident " + incident.priority.value.upper() + " " +
-                      str(incident.id) + " - Incident management room"
-        )
+        with resilience.guard('slack', 'channels.setPurpose'):
+            self.slack.channels.set_purpose(
+                channel = incident.slack_channel_id,
+                purpose = "Incident " + incident.priority.value.upper() + " " +
+                          str(incident.id) + " - Incident management room"
+            )
+        self.invalidate_slack_channel(incident.slack_channel_id)
         log.debug("... defined channel purpose")
+
+    def set_slack_channel_topic(self, incident):
         log.debug("... defining channel title")
-        self.slack.channels.set_topic(
-            channel = incident.slack_channel_id,
-            topic = incident.title
-        )
+        with resilience.guard('slack', 'channels.setTopic'):
+            self.slack.channels.set_topic(
+                channel = incident.slack_channel_id,
+                topic = incident.title
+            )
+        self.invalidate_slack_channel(incident.slack_channel_id)
         log.debug("... defined channel title")
 
+    def announce_new_incidents(self, incidents):
+        """Announce new incidents having a channel, in a single message"""
+        incidents = [incident for incident in incidents
+                     if incident.slack_channel_id is not None]
+        if len(incidents) == 1:
+            self.post_new_incident_announce_on_slack(incidents[0])
+        elif incidents:
+            self.post_new_incidents_announce_on_slack(incidents)
+
+    def post_new_incidents_announce_on_slack(self, incidents):
+        log.debug("Posting announce of %s new incidents ...", len(incidents))
+        message = self.templates.render('announce_batch',
+                                        {'count': str(len(incidents))})
+        message['attachments'] = [
+            attachment for incident in incidents
+            for attachment in self.templates.render(
+                'announce_batch_item',
+                incident.template_values())['attachments']]
+        with self.slack_session.priority(PRIORITY_HIGH), \
+                resilience.guard('slack', 'chat.postMessage'):
+            self.slack.chat.post_message(
+                channel=self.slack_channel,
+                as_user=True,
+                **message)
+        log.debug("Posted new incidents announce")
+
     def post_new_incident_announce_on_slack(self, incident):
         log.debug("Posting new incident announce ...")
-        self.slack.chat.post_message(
-            channel=self.slack_channel,
-            text='',
-            as_user=True,
-            attachments=[
-                {
-                    "text": ":warning: New incident opened: *" +
-                            incident.slack_channel + "* :warning:",
-                    "color": incident.get_color(),
-                    "mrkdwn_in": ["text"],
-                    "fields": [
-                        {"title": "Title", "value": str(incident.title), "short": False},
-                        {"title": "State", "value": incident.state.value, "short": True},
-                        {"title": "ID", "value": str(incident.id), "short": True},
-                        {"title": "Priority", "value": incident.priority.value, "short": True},
-                        {"title": "Jira Issue",
-                         "value": "<{jira_server}/browse/{jira_issue}|{jira_issue}>".format(
-                             jira_server=config['jira']['host'],
-                             jira_issue=incident.jira_issue),
-                         "short": True},
-                        {"title": "Description", "value": str(incident.description), "short": False}
-                    ]
-                },
-                {
-                    "text": "Please join channel <#" + incident.slack_channel_id + ">",
-                    "mrkdwn_in": ["text"],
-                    "color": incident.get_color()
-                }
-            ])
+        # Announcements go first when rate limited
+        with self.slack_session.priority(PRIORITY_HIGH), \
+                resilience.guard('slack', 'chat.postMessage'):
+            self.slack.chat.post_message(
+                channel=self.slack_channel,
+                as_user=True,
+                **self.templates.render('announce',
+                                        incident.template_values()))
         log.debug("Posted new incident announce")
 
     def post_new_incident_summary(self, incident):
         log.debug("Posting new incident summary ...")
-        self.slack.chat.post_message(
-            channel=incident.slack_channel,
-            text='',
-            as_user=True,
-            attachments=[
-                {
-                    "text": ":warning: Welcome to this new code handling channel\n" +
-                            "As a reminder, here are the informations so far:",
-                    "mrkdwn_in": ["text"],
-                    "fields": [
-                        {"title": "Title", "value": str(incident.title), "short": False},
-                        {"title": "State", "value": incident.state.value, "short": True},
-                        {"title": "ID", "value": str(incident.id), "short": True},
-                        {"title": "Priority", "value": incident.priority.value, "short": True},
-                        {"title": "Jira Issue",
-                         "value": "<{jira_server}/browse/{jira_issue}|{jira_issue}>".format(
-                             jira_server=config['jira']['host'],
-                             jira_issue=incident.jira_issue),
-                         "short": True},
-                        {"title": "Description", "value": str(incident.description), "short": False}
-                    ]
-                }
-            ])
+        # Summaries yield to announcements when rate limited
+        with self.slack_session.priority(PRIORITY_LOW), \
+                resilience.guard('slack', 'chat.postMessage'):
+            self.slack.chat.post_message(
+                channel=incident.slack_channel,
+                as_user=True,
+                **self.templates.render('summary',
+                                        incident.template_values()))
         log.debug("Posted new incident summary")
 
+    def incident_lock(self, channel_id):
+        """Lock of the incident of a channel"""
+        with self.incident_locks_lock:
+            lock = self.incident_locks.get(channel_id)
+            if lock is None:
+                lock = threading.RLock()
+                self.incident_locks[channel_id] = lock
+            return lock
+
+    @contextmanager
+    def locked_incident(self, channel_id):
+        """
+        Incident of a channel, with its lock held so that operations on an
+        incident run one at a time
+        """
+        with self.incident_lock(channel_id):
+            yield self.get_incident_from_channel(channel_id)
+
+    def get_incident_from_channel(self, channel_id):
+        """Get incident from the local store, or from Elasticsearch on a miss"""
+        incident = self.store.get_by_channel(channel_id)
+        if incident is not None:
+            if not self.shared_state:
+                return incident
+            # Other processes may have changed it since
+            return self.reload_incident(incident.id)
+        hit = self.find_incident_from_channel(channel_id)
+        if hit is None:
+            return
+        incident = Incident(manager=self).unserialize(hit['_source'])
+        if self.shared_state:
+            # Like reloaded incidents, writes then check nobody else wrote
+            # it since
+            incident.version = hit['_version']
+        self.store.put(incident)
+        self.index.put(incident)
+        return incident
+
+    def reload_incident(self, incident_id):
+        """Get the latest version of an incident, by ID"""
+        # Our own buffered writes first, then a realtime get: no search nor
+        # refresh needed
+        self.es_writer.flush()
+        with resilience.guard('elasticsearch', 'get'):
+            res = self.es.get(index=self.es_index, doc_type="incident",
+                              id=incident_id)
+        incident = Incident(manager=self).unserialize(res['_source'])
+        # Writes then check nobody else wrote it in the meantime
+        incident.version = res['_version']
+        self.store.put(incident)
+        self.index.put(incident)
+        return incident
+
     def find_incident_from_channel(self, channel_id):
-        log.debug("Searching incident from channel ID " + channel_id + " ...")
-        res = self.es.search(
-            index = self.es_index,
-            doc_type = "incident",
-            q = "slack_channel_id:" + channel_id
-        )
+        log.debug("Searching incident from channel ID %s ...", channel_id)
+        with resilience.guard('elasticsearch', 'search'):
+            res = self.es.search(
+                index = self.es_index,
+                doc_type = "incident",
+                q = "slack_channel_id:" + channel_id,
+                version = True
+            )
         if res['hits']['total'] == 0:
             log.warning("... could not found any corresponding incident, sorry, aborting")
             return
         if res['hits']['total'] != 1:
-            log.warning("... found multiple (" + str(res['hits']) +
-                        ") channels which shouldn't happen, aborting")
+            log.warning("... found multiple (%s) channels which shouldn't "
+                        "happen, aborting", res['hits'])
             return
-        incident_json = res['hits']['hits'][0]['_source']
-        return incident_json
+        # The hit, with the document `_version`
+        return res['hits']['hits'][0]
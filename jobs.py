@@ -0,0 +1,162 @@
+from collections import OrderedDict, deque
+from datetime import datetime
+from enum import Enum
+import contextvars
+import queue
+import threading
+import uuid
+
+from log import log, request_id
+
+
+class JobState(Enum):
+    QUEUED  = "queued"
+    RUNNING = "running"
+    DONE    = "done"
+    FAILED  = "failed"
+
+
+class Job(object):
+    def __init__(self, name, func, args, kwargs, key=None):
+        self.id             = uuid.uuid4().hex
+        self.name           = name
+        self.key            = key
+        # Jobs run in the context they were submitted from (request ID)
+        self.context        = contextvars.copy_context()
+        self.request_id     = request_id.get()
+        self.func           = func
+        self.args           = args
+        self.kwargs         = kwargs
+        self.state          = JobState.QUEUED
+        self.error          = None
+        self.queued_time    = datetime.now()
+        self.start_time     = None
+        self.end_time       = None
+
+    def to_dict(self):
+        """Public view of the job, as exposed on the /jobs endpoints"""
+        return {
+            'id': self.id,
+            'name': self.name,
+            'request_id': self.request_id,
+            'state': self.state.value,
+            'error': self.error,
+            'queued_time': self.queued_time.isoformat(),
+            'start_time': self.start_time and self.start_time.isoformat(),
+            'end_time': self.end_time and self.end_time.isoformat()
+        }
+
+
+class JobQueue(object):
+    """
+    Pool of worker threads running side effects out of the request path
+
+    Finished jobs are kept in a bounded history so their status can still be
+    queried for a while after they ran; queued and running jobs are always
+    kept.
+
+    Jobs submitted with the same key (e.g. on the same incident) run one at a
+    time, in the order they were submitted; jobs with different keys still
+    run in parallel.
+    """
+    def __init__(self, workers=4, history=1000):
+        self.workers_count  = workers
+        self.history        = history
+        self.queue          = queue.Queue()
+        self.jobs           = OrderedDict()
+        self.lock           = threading.Lock()
+        self.workers        = []
+        # Jobs waiting for the running job of their key, by key
+        self.waiting        = {}
+
+    def start(self):
+        log.info("Starting %s job workers ...", self.workers_count)
+        for idx in range(self.workers_count):
+            worker = threading.Thread(target=self._work,
+                                      name="job-worker-" + str(idx),
+                                      daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, name, func, *args, **kwargs):
+        return self._submit(Job(name, func, args, kwargs))
+
+    def submit_in_order(self, key, name, func, *args, **kwargs):
+        """Submit a job to run after the jobs already submitted with `key`"""
+        return self._submit(Job(name, func, args, kwargs, key=key))
+
+    def _submit(self, job):
+        with self.lock:
+            self.jobs[job.id] = job
+            self._trim()
+            if job.key is not None:
+                if job.key in self.waiting:
+                    self.waiting[job.key].append(job)
+                    log.debug("Queued job %s (%s) after running job of %s",
+                              job.id, job.name, job.key)
+                    return job
+                self.waiting[job.key] = deque()
+        self.queue.put(job)
+        log.debug("Queued job %s (%s)", job.id, job.name)
+        return job
+
+    def _trim(self):
+        """Forget the oldest finished jobs beyond the history size"""
+        excess = len(self.jobs) - self.history
+        if excess <= 0:
+            return
+        finished = [job_id for job_id, job in self.jobs.items()
+                    if job.state in (JobState.DONE, JobState.FAILED)]
+        for job_id in finished[:excess]:
+            del self.jobs[job_id]
+
+    def _release(self, key):
+        """Queue the next job of a key, once the previous one is finished"""
+        with self.lock:
+            waiting = self.waiting[key]
+            if not waiting:
+                del self.waiting[key]
+                return
+            job = waiting.popleft()
+        self.queue.put(job)
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def depth(self):
+        with self.lock:
+            waiting = sum(len(jobs) for jobs in self.waiting.values())
+        return self.queue.qsize() + waiting
+
+    def stats(self):
+        with self.lock:
+            states = [job.state for job in self.jobs.values()]
+        return {
+            'depth': self.depth(),
+            'workers': self.workers_count,
+            'jobs': {state.value: states.count(state) for state in JobState}
+        }
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            job.state = JobState.RUNNING
+            job.start_time = datetime.now()
+            log.debug("Running job %s (%s) ...", job.id, job.name)
+            # noinspection PyBroadException
+            try:
+                job.context.run(job.func, *job.args, **job.kwargs)
+                job.state = JobState.DONE
+                log.debug("... job %s done", job.id)
+            except Exception as e:
+                job.error = str(e)
+                job.state = JobState.FAILED
+                log.exception("Job %s (%s) failed", job.id, job.name)
+            finally:
+                job.end_time = datetime.now()
+                # Drop references to the payload once the job ran
+                job.func = job.args = job.kwargs = job.context = None
+                if job.key is not None:
+                    self._release(job.key)
+                self.queue.task_done()
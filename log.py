@@ -1,11 +1,63 @@
+import atexit
+import contextvars
+import json
 import logging
+import logging.handlers
+import queue
+
+from config import config
+
+TEXT_FORMAT = '[%(levelname)s] [%(request_id)s] %(message)s'
+
+# ID of the request being handled, carried to the threads working for it
+request_id = contextvars.ContextVar('request_id', default='-')
+
+# Attributes of every record, the others were given through `extra`
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message'}
+
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = request_id.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with the fields given through `extra`"""
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'request_id': getattr(record, 'request_id', '-'),
+            'thread': record.threadName,
+            'message': record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES and key not in entry:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+log_config = config.get('logging', {})
 
 log = logging.getLogger('incidents-bot')
+log.setLevel(log_config.get('level', 'INFO').upper())
+log.propagate = False
 
-log.setLevel(logging.DEBUG)
+# Records are formatted by the calling thread, then written by a background
+# thread so that requests never wait on stderr
 ch = logging.StreamHandler()
-ch.setLevel(logging.DEBUG)
-formatter = logging.Formatter('[%(levelname)s] %(message)s')
-ch.setFormatter(formatter)
-log.addHandler(ch)
+if log_config.get('format', 'text') == 'json':
+    ch.setFormatter(JsonFormatter())
+else:
+    ch.setFormatter(logging.Formatter(TEXT_FORMAT))
+log_queue = queue.Queue()
+queue_handler = logging.handlers.QueueHandler(log_queue)
+queue_handler.addFilter(RequestIdFilter())
+log.addHandler(queue_handler)
+listener = logging.handlers.QueueListener(log_queue, ch)
+listener.start()
+atexit.register(listener.stop)
 log.info("Hello")
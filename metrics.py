@@ -0,0 +1,140 @@
+from contextlib import contextmanager
+import bisect
+import threading
+import time
+
+# Upper bounds, in seconds, of the latency histograms buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0)
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                                         .replace('"', '\\"'))
+        for name, value in zip(names, values)) + "}"
+
+
+class Histogram(object):
+    """Latency histogram, with one series per combination of label values"""
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name           = name
+        self.description    = description
+        self.labels         = tuple(labels)
+        self.buckets        = tuple(buckets)
+        self.series         = {}
+        self.lock           = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = {'buckets': [0] * len(self.buckets),
+                          'sum': 0.0, 'count': 0}
+                self.series[label_values] = series
+            idx = bisect.bisect_left(self.buckets, value)
+            if idx < len(self.buckets):
+                series['buckets'][idx] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.description),
+                 "# TYPE {} histogram".format(self.name)]
+        with self.lock:
+            series = [(values, dict(s, buckets=list(s['buckets'])))
+                      for values, s in sorted(self.series.items())]
+        bucket_labels = self.labels + ('le',)
+        for values, s in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets, s['buckets']):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(
+                    self.name, format_labels(bucket_labels, values + (bound,)),
+                    cumulative))
+            lines.append("{}_bucket{} {}".format(
+                self.name, format_labels(bucket_labels, values + ('+Inf',)),
+                s['count']))
+            lines.append("{}_sum{} {}".format(
+                self.name, format_labels(self.labels, values), s['sum']))
+            lines.append("{}_count{} {}".format(
+                self.name, format_labels(self.labels, values), s['count']))
+        return lines
+
+
+class Gauge(object):
+    """Gauge read from a callback returning {label values tuple: value}"""
+    def __init__(self, name, description, labels, collect):
+        self.name           = name
+        self.description    = description
+        self.labels         = tuple(labels)
+        self.collect        = collect
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.description),
+                 "# TYPE {} gauge".format(self.name)]
+        for values, value in sorted(self.collect().items()):
+            lines.append("{}{} {}".format(
+                self.name, format_labels(self.labels, values), value))
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics    = []
+        self.lock       = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Render every metric in the Prometheus text exposition format"""
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+backend_latency = registry.register(Histogram(
+    'incidents_backend_call_duration_seconds',
+    "Duration of calls to backends (Slack, Jira, Elasticsearch, Cachet)",
+    labels=('backend', 'method', 'outcome')))
+
+intent_latency = registry.register(Histogram(
+    'incidents_intent_duration_seconds',
+    "End-to-end duration of intents handling",
+    labels=('intent', 'outcome')))
+
+webhook_latency = registry.register(Histogram(
+    'incidents_webhook_duration_seconds',
+    "Duration of webhook requests, until the answer is sent back",
+    labels=('intent',)))
+
+
+class Span(object):
+    """Call being timed, with the seconds it spent paused"""
+    def __init__(self):
+        self.paused = 0.0
+
+
+@contextmanager
+def span(backend, method):
+    """Time a call to a backend, leaving out the time it was paused"""
+    current = Span()
+    start = time.perf_counter()
+    outcome = 'error'
+    try:
+        yield current
+        outcome = 'success'
+    finally:
+        backend_latency.observe(time.perf_counter() - start - current.paused,
+                                backend, method, outcome)
+
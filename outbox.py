@@ -0,0 +1,212 @@
+import json
+import random
+import sqlite3
+import threading
+import time
+
+from log import log, request_id
+from resilience import resilience, PermanentError, CircuitOpenError, \
+    BulkheadFullError
+
+# Outbox entries `o` that no live entry of the same key is due before
+FIRST_OF_KEY = ("(o.ordering_key IS NULL OR NOT EXISTS ("
+                "SELECT 1 FROM outbox p WHERE p.backend = o.backend "
+                "AND p.ordering_key = o.ordering_key AND p.dead = 0 "
+                "AND p.id < o.id))")
+
+
+class Outbox(object):
+    """
+    Side effects on non-critical backends (Cachet, Jira), stored in SQLite
+    until they succeed
+
+    `enqueue` returns as soon as the side effect is stored. A dispatcher
+    thread per backend then runs them through the registered handlers,
+    retrying failures with an exponential backoff, and waiting while the
+    backend's circuit is open. Side effects with the same `key` (e.g. of the
+    same incident) run in order: a failing one only holds back the ones
+    behind it. Side effects failing `max_attempts` times, or raising
+    `PermanentError`, are kept aside as dead instead of blocking them.
+
+    A side effect being run is leased for `lease` seconds, so several
+    processes can share the same database without running it twice.
+    """
+    def __init__(self, path, backoff=1.0, max_backoff=300.0, max_attempts=50,
+                 lease=60.0, poll_interval=1.0):
+        self.path               = path
+        self.backoff            = backoff
+        self.max_backoff        = max_backoff
+        self.max_attempts       = max_attempts
+        self.lease              = lease
+        self.poll_interval      = poll_interval
+        self.handlers           = {}
+        self.wakeups            = {}
+        self.lock               = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None,
+                                  check_same_thread=False)
+        with self.lock:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS outbox ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " backend TEXT NOT NULL,"
+                " action TEXT NOT NULL,"
+                " payload TEXT NOT NULL,"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " next_try REAL NOT NULL,"
+                " created REAL NOT NULL,"
+                " last_error TEXT,"
+                " request_id TEXT,"
+                " dead INTEGER NOT NULL DEFAULT 0,"
+                " ordering_key TEXT)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS outbox_pending "
+                            "ON outbox (backend, dead, id)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS outbox_ordering "
+                            "ON outbox (backend, ordering_key, dead, id)")
+
+    def register(self, backend, action, handler):
+        """Run `handler(payload)` for the `action` side effects on `backend`"""
+        self.handlers[(backend, action)] = handler
+        self.wakeups.setdefault(backend, threading.Event())
+
+    def start(self):
+        for backend in self.wakeups:
+            threading.Thread(target=self._dispatch, args=(backend,),
+                             name="outbox-" + backend, daemon=True).start()
+
+    def enqueue(self, backend, action, payload, delay=0, key=None):
+        """
+        Store a side effect, to run not before `delay` seconds, and after the
+        previous ones with the same `key`
+        """
+        if (backend, action) not in self.handlers:
+            raise ValueError("No handler for " + backend + " " + action)
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO outbox (backend, action, payload, next_try, "
+                "created, request_id, ordering_key) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (backend, action, json.dumps(payload), now + delay, now,
+                 request_id.get(), key))
+        log.debug("Queued %s %s in outbox", backend, action)
+        self.wakeups[backend].set()
+
+    def stats(self):
+        with self.lock:
+            counts = self.db.execute(
+                "SELECT backend, dead, COUNT(*) FROM outbox "
+                "GROUP BY backend, dead").fetchall()
+        stats = {backend: {'pending': 0, 'dead': 0,
+                           'circuit': resilience.breaker(backend).status()}
+                 for backend in self.wakeups}
+        for backend, dead, count in counts:
+            stats.setdefault(backend, {'pending': 0, 'dead': 0})
+            stats[backend]['dead' if dead else 'pending'] = count
+        return stats
+
+    def _dispatch(self, backend):
+        wakeup = self.wakeups[backend]
+        while True:
+            wakeup.clear()
+            # noinspection PyBroadException
+            try:
+                delay = self._run_next(backend)
+            except Exception:
+                log.exception("Outbox dispatcher of %s failed", backend)
+                delay = self.poll_interval
+            if delay > 0:
+                wakeup.wait(delay)
+
+    def _claim_next(self, backend):
+        """
+        Lease the oldest side effect of a backend that is due, and first of
+        its key
+
+        Returns it, or how long to wait before one could be run.
+        """
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(
+                "SELECT id, action, payload, attempts, next_try, request_id "
+                "FROM outbox o WHERE backend = ? AND dead = 0 "
+                "AND next_try <= ? AND " + FIRST_OF_KEY + " "
+                "ORDER BY id LIMIT 1",
+                (backend, now)).fetchone()
+            if row is None:
+                next_try = self.db.execute(
+                    "SELECT MIN(next_try) FROM outbox o "
+                    "WHERE backend = ? AND dead = 0 AND " + FIRST_OF_KEY,
+                    (backend,)).fetchone()[0]
+                if next_try is None:
+                    return None, self.poll_interval
+                return None, max(0, min(next_try - now, self.poll_interval))
+            # Another process may have claimed it in the meantime
+            claimed = self.db.execute(
+                "UPDATE outbox SET next_try = ? WHERE id = ? AND next_try = ?",
+                (now + self.lease, row[0], row[4])).rowcount
+        if not claimed:
+            return None, 0
+        return row, 0
+
+    def _run_next(self, backend):
+        """Run the next side effect of a backend, return how long to wait"""
+        remaining = resilience.breaker(backend).remaining()
+        if remaining > 0:
+            return remaining
+        row, delay = self._claim_next(backend)
+        if row is None:
+            return delay
+        entry_id, action, payload, attempts, _, entry_request_id = row
+        handler = self.handlers.get((backend, action))
+        # Logs carry the ID of the request the side effect comes from
+        token = request_id.set(entry_request_id or '-')
+        try:
+            return self._run(backend, entry_id, action, payload, attempts,
+                             handler)
+        finally:
+            request_id.reset(token)
+
+    def _run(self, backend, entry_id, action, payload, attempts, handler):
+        try:
+            if handler is None:
+                raise PermanentError("No handler for " + action)
+            handler(json.loads(payload))
+        except (CircuitOpenError, BulkheadFullError) as e:
+            # The backend wasn't called, this isn't an attempt
+            log.debug("Postponing %s %s: %s", backend, action, e)
+            with self.lock:
+                self.db.execute("UPDATE outbox SET next_try = ? WHERE id = ?",
+                                (time.time(), entry_id))
+            return self.poll_interval
+        except PermanentError as e:
+            log.error("Giving up on %s %s: %s", backend, action, e)
+            self._bury(entry_id, str(e))
+            return 0
+        except Exception as e:
+            attempts += 1
+            if attempts >= self.max_attempts:
+                log.error("Giving up on %s %s after %s attempts: %s",
+                          backend, action, attempts, e)
+                self._bury(entry_id, str(e))
+                return 0
+            delay = min(self.max_backoff, self.backoff * 2 ** (attempts - 1))
+            delay *= random.uniform(0.5, 1.0)
+            log.warning("%s %s failed (attempt %s), retrying in %.1fs: %s",
+                        backend, action, attempts, delay, e)
+            with self.lock:
+                self.db.execute(
+                    "UPDATE outbox SET attempts = ?, next_try = ?, "
+                    "last_error = ? WHERE id = ?",
+                    (attempts, time.time() + delay, str(e), entry_id))
+            return 0
+        with self.lock:
+            self.db.execute("DELETE FROM outbox WHERE id = ?", (entry_id,))
+        log.debug("Ran %s %s from outbox", backend, action)
+        return 0
+
+    def _bury(self, entry_id, error):
+        with self.lock:
+            self.db.execute(
+                "UPDATE outbox SET dead = 1, last_error = ? WHERE id = ?",
+                (error, entry_id))
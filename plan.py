@@ -0,0 +1,101 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import contextvars
+import threading
+
+from config import config
+from log import log
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Thread pool shared by every execution plan"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=config.get('fanout', {}).get('workers', 16),
+                thread_name_prefix='fanout')
+        return _executor
+
+
+class Step(object):
+    def __init__(self, name, func, args, kwargs, depends_on, after):
+        self.name       = name
+        self.func       = func
+        self.args       = args
+        self.kwargs     = kwargs
+        self.depends_on = set(depends_on)
+        self.after      = set(after)
+
+
+class ExecutionPlan(object):
+    """
+    Set of named steps run concurrently, each one as soon as the steps it
+    depends on are done
+
+    If a step fails, the steps depending on it are skipped, the others still
+    run, and the first error is raised once everything settled; `errors` then
+    holds the error of every failed step. Steps only waiting for others to
+    settle, successfully or not, list them as `after`.
+
+    Steps must not run plans themselves: they would wait on the same pool.
+    """
+    def __init__(self, name):
+        self.name   = name
+        self.steps  = {}
+        self.errors = {}
+
+    def add(self, name, func, *args, depends_on=(), after=(), **kwargs):
+        for dependency in tuple(depends_on) + tuple(after):
+            if dependency not in self.steps:
+                raise ValueError("Unknown dependency " + dependency +
+                                 " for step " + name)
+        self.steps[name] = Step(name, func, args, kwargs, depends_on, after)
+        return self
+
+    def run(self):
+        log.debug("Running plan %s ...", self.name)
+        executor = get_executor()
+        pending = dict(self.steps)
+        running = {}
+        done = set()
+        failed = set()
+        results = {}
+        first_error = None
+        while pending or running:
+            for step in list(pending.values()):
+                if step.depends_on & failed:
+                    log.warning("Skipping step %s of plan %s, a dependency "
+                                "failed", step.name, self.name)
+                    del pending[step.name]
+                    failed.add(step.name)
+                elif step.depends_on <= done and \
+                        step.after <= done | failed:
+                    del pending[step.name]
+                    # Steps run in the context of the plan (request ID)
+                    future = executor.submit(
+                        contextvars.copy_context().run, step.func,
+                        *step.args, **step.kwargs)
+                    running[future] = step
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                step = running.pop(future)
+                error = future.exception()
+                if error is None:
+                    results[step.name] = future.result()
+                    done.add(step.name)
+                else:
+                    log.error("Step %s of plan %s failed: %r", step.name,
+                              self.name, error)
+                    failed.add(step.name)
+                    self.errors[step.name] = error
+                    if first_error is None:
+                        first_error = error
+        if first_error is not None:
+            raise first_error
+        log.debug("... plan %s done", self.name)
+        return results
@@ -0,0 +1,293 @@
+from contextlib import contextmanager
+from enum import Enum
+import contextvars
+import threading
+import time
+
+from slacker import Error as SlackerError
+
+from config import config
+from log import log
+from metrics import span
+
+DEFAULT_MAX_CONCURRENT  = 20
+DEFAULT_MAX_WAIT        = 5.0
+DEFAULT_FAILURES        = 5
+DEFAULT_COOLDOWN        = 30.0
+
+# Calls guarded by the running code, by backend
+guarded = contextvars.ContextVar('guarded', default={})
+
+
+class PermanentError(Exception):
+    """Raised for calls that no retry will fix"""
+    pass
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a backend whose circuit is open"""
+    pass
+
+
+class BulkheadFullError(Exception):
+    """Raised when too many calls to a backend are already running"""
+    pass
+
+
+def is_backend_failure(error):
+    """
+    Whether an error tells something is wrong with the backend, rather than
+    with the request (e.g. Slack's `name_taken`, a Jira 400 or an ES 409)
+    """
+    if isinstance(error, (PermanentError, SlackerError)):
+        return False
+    status_code = getattr(error, 'status_code', None)
+    if isinstance(status_code, int) and status_code < 500 and \
+            status_code != 429:
+        return False
+    return True
+
+
+class CircuitState(Enum):
+    CLOSED      = "closed"
+    OPEN        = "open"
+    HALF_OPEN   = "half_open"
+
+
+class CircuitBreaker(object):
+    """
+    Stop calling a backend after `failures` consecutive failures
+
+    Once open, the circuit lets a single call through after `cooldown`
+    seconds: it closes again if that call succeeds, and stays open for
+    another `cooldown` otherwise.
+    """
+    def __init__(self, name, failures=DEFAULT_FAILURES,
+                 cooldown=DEFAULT_COOLDOWN):
+        self.name           = name
+        self.failures       = failures
+        self.cooldown       = cooldown
+        self.state          = CircuitState.CLOSED
+        self.failed         = 0
+        self.opened_at      = None
+        self.lock           = threading.Lock()
+
+    def acquire(self):
+        """Whether a call can go through now"""
+        with self.lock:
+            if self.state == CircuitState.CLOSED:
+                return True
+            if self.state == CircuitState.HALF_OPEN:
+                # A trial call is already running
+                return False
+            if time.monotonic() < self.opened_at + self.cooldown:
+                return False
+            self.state = CircuitState.HALF_OPEN
+            return True
+
+    def remaining(self):
+        """Seconds before the circuit lets a call through, 0 if closed"""
+        with self.lock:
+            if self.state != CircuitState.OPEN:
+                return 0
+            return max(0, self.opened_at + self.cooldown - time.monotonic())
+
+    def success(self):
+        with self.lock:
+            if self.state != CircuitState.CLOSED:
+                log.info("Circuit of %s closed", self.name)
+            self.state = CircuitState.CLOSED
+            self.failed = 0
+
+    def failure(self):
+        with self.lock:
+            self.failed += 1
+            if self.state == CircuitState.HALF_OPEN or \
+                    self.failed >= self.failures:
+                if self.state != CircuitState.OPEN:
+                    log.warning("Circuit of %s opened after %s failures",
+                                self.name, self.failed)
+                self.state = CircuitState.OPEN
+                self.opened_at = time.monotonic()
+
+    def status(self):
+        with self.lock:
+            return {'state': self.state.value, 'failures': self.failed}
+
+
+class Bulkhead(object):
+    """
+    Limit the calls running at once to a backend, so that a slow backend
+    can't take every worker thread with it
+
+    Calls beyond `max_concurrent` wait up to `max_wait` seconds for a slot.
+    """
+    def __init__(self, name, max_concurrent=DEFAULT_MAX_CONCURRENT,
+                 max_wait=DEFAULT_MAX_WAIT):
+        self.name           = name
+        self.max_concurrent = max_concurrent
+        self.max_wait       = max_wait
+        self.slots          = threading.BoundedSemaphore(max_concurrent)
+        self.in_flight      = 0
+        self.rejected       = 0
+        self.lock           = threading.Lock()
+
+    def acquire(self):
+        if not self.slots.acquire(timeout=self.max_wait):
+            with self.lock:
+                self.rejected += 1
+            raise BulkheadFullError("Too many calls to " + self.name)
+        with self.lock:
+            self.in_flight += 1
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+        self.slots.release()
+
+    def status(self):
+        with self.lock:
+            return {'max_concurrent': self.max_concurrent,
+                    'in_flight': self.in_flight,
+                    'rejected': self.rejected}
+
+
+class GuardedCall(object):
+    """Call to a backend running within its guard"""
+    def __init__(self, bulkhead):
+        # Copied contexts don't carry guards into other threads
+        self.thread     = threading.get_ident()
+        self.bulkhead   = bulkhead
+        self.holding    = False
+        self.span       = None
+
+    def enter(self):
+        self.bulkhead.acquire()
+        self.holding = True
+
+    def leave(self):
+        if self.holding:
+            self.holding = False
+            self.bulkhead.release()
+
+
+def current_call(backend):
+    """Guarded call to a backend this thread is running, if any"""
+    call = guarded.get().get(backend)
+    if call is not None and call.thread == threading.get_ident():
+        return call
+    return None
+
+
+class Resilience(object):
+    """
+    Circuit breaker and bulkhead of each backend
+
+    Settings come from the `resilience` configuration, per backend, falling
+    back on `resilience.default`. Request timeouts are the connection pools'
+    (`connections.py`).
+    """
+    def __init__(self, resilience_config):
+        self.config     = resilience_config
+        self.breakers   = {}
+        self.bulkheads  = {}
+        self.lock       = threading.Lock()
+
+    def _setup(self, backend):
+        with self.lock:
+            if backend in self.breakers:
+                return
+            backend_config = dict(self.config.get('default', {}),
+                                  **self.config.get(backend, {}))
+            self.breakers[backend] = CircuitBreaker(
+                backend,
+                failures=backend_config.get('circuit_failures',
+                                            DEFAULT_FAILURES),
+                cooldown=backend_config.get('circuit_cooldown',
+                                            DEFAULT_COOLDOWN))
+            self.bulkheads[backend] = Bulkhead(
+                backend,
+                max_concurrent=backend_config.get('max_concurrent',
+                                                  DEFAULT_MAX_CONCURRENT),
+                max_wait=backend_config.get('max_wait', DEFAULT_MAX_WAIT))
+
+    def breaker(self, backend):
+        self._setup(backend)
+        return self.breakers[backend]
+
+    def bulkhead(self, backend):
+        self._setup(backend)
+        return self.bulkheads[backend]
+
+    @contextmanager
+    def guard(self, backend, method):
+        """
+        Call a backend through its circuit breaker and bulkhead, timing the
+        call
+
+        Guards are re-entrant: calls made within the guard of the same
+        backend, e.g. connecting to it on first use, are only timed. The
+        outer guard counts their outcome, and holds the trial call and the
+        bulkhead slot for them.
+        """
+        if current_call(backend) is not None:
+            with span(backend, method):
+                yield
+            return
+        breaker = self.breaker(backend)
+        if not breaker.acquire():
+            raise CircuitOpenError("Circuit of " + backend + " is open, not "
+                                   "calling " + method)
+        call = GuardedCall(self.bulkhead(backend))
+        token = guarded.set(dict(guarded.get(), **{backend: call}))
+        try:
+            call.enter()
+            try:
+                with span(backend, method) as call.span:
+                    yield
+            finally:
+                call.leave()
+        except BulkheadFullError:
+            # The backend wasn't called: a trial call has to be tried again
+            # after another cooldown
+            if breaker.state == CircuitState.HALF_OPEN:
+                breaker.failure()
+            raise
+        except Exception as e:
+            if is_backend_failure(e):
+                breaker.failure()
+            else:
+                breaker.success()
+            raise
+        finally:
+            guarded.reset(token)
+        breaker.success()
+
+    @contextmanager
+    def waiting(self, backend):
+        """
+        Wait within the guard of a backend, e.g. for a rate limiter, without
+        holding its bulkhead slot nor counting the wait in its latency
+        """
+        call = current_call(backend)
+        if call is None or not call.holding:
+            yield
+            return
+        call.leave()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if call.span is not None:
+                call.span.paused += time.perf_counter() - start
+        call.enter()
+
+    def stats(self):
+        with self.lock:
+            backends = list(self.breakers)
+        return {backend: {'circuit': self.breakers[backend].status(),
+                          'bulkhead': self.bulkheads[backend].status()}
+                for backend in backends}
+
+
+resilience = Resilience(config.get('resilience', {}))
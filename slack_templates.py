@@ -0,0 +1,147 @@
+from string import Formatter
+
+# Values every template can use, as strings, see `Incident.template_values`
+VALUES = ('id', 'title', 'description', 'state', 'priority', 'color',
+          'jira_link', 'slack_channel', 'slack_channel_id', 'count')
+
+# Messages layouts: `text` and `attachments` of `chat.postMessage`, with
+# `{value}` placeholders in strings
+DEFAULT_TEMPLATES = {
+    'announce': {
+        'text': '',
+        'attachments': [
+            {
+                "text": ":warning: New incident opened: *{slack_channel}* "
+                        ":warning:",
+                "color": "{color}",
+                "mrkdwn_in": ["text"],
+                "fields": [
+                    {"title": "Title", "value": "{title}", "short": False},
+                    {"title": "State", "value": "{state}", "short": True},
+                    {"title": "ID", "value": "{id}", "short": True},
+                    {"title": "Priority", "value": "{priority}", "short": True},
+                    {"title": "Jira Issue", "value": "{jira_link}",
+                     "short": True},
+                    {"title": "Description", "value": "{description}",
+                     "short": False}
+                ]
+            },
+            {
+                "text": "Please join channel <#{slack_channel_id}>",
+                "mrkdwn_in": ["text"],
+                "color": "{color}"
+            }
+        ]
+    },
+    # Announce of several incidents: one attachment for each of them
+    'announce_batch': {
+        'text': ":warning: {count} new incidents opened :warning:",
+    },
+    'announce_batch_item': {
+        'attachments': [
+            {
+                "text": "*{slack_channel}*: {title} - please join "
+                        "<#{slack_channel_id}>",
+                "color": "{color}",
+                "mrkdwn_in": ["text"],
+                "fields": [
+                    {"title": "ID", "value": "{id}", "short": True},
+                    {"title": "Priority", "value": "{priority}", "short": True},
+                    {"title": "Jira Issue", "value": "{jira_link}",
+                     "short": True},
+                    {"title": "Description", "value": "{description}",
+                     "short": False}
+                ]
+            }
+        ]
+    },
+    'summary': {
+        'text': '',
+        'attachments': [
+            {
+                "text": ":warning: Welcome to this new code handling "
+                        "channel\nAs a reminder, here are the informations "
+                        "so far:",
+                "mrkdwn_in": ["text"],
+                "fields": [
+                    {"title": "Title", "value": "{title}", "short": False},
+                    {"title": "State", "value": "{state}", "short": True},
+                    {"title": "ID", "value": "{id}", "short": True},
+                    {"title": "Priority", "value": "{priority}", "short": True},
+                    {"title": "Jira Issue", "value": "{jira_link}",
+                     "short": True},
+                    {"title": "Description", "value": "{description}",
+                     "short": False}
+                ]
+            }
+        ]
+    },
+    'close_confirmation': {
+        'text': '',
+        'attachments': [
+            {
+                "text": "Closing this incident, good job :+1:",
+                "color": "good",
+                "mrkdwn_in": ["text"],
+                "short": False,
+                "fields": [
+                    {"title": "Jira Issue", "value": "{jira_link}",
+                     "short": True},
+                    {"title": "State", "value": "{state}", "short": True}
+                ]
+            }
+        ]
+    }
+}
+
+
+def check_layout(name, layout):
+    """Raise `ValueError` if a layout uses values that don't exist"""
+    if isinstance(layout, str):
+        for literal, value, spec, conversion in Formatter().parse(layout):
+            if value is not None and value not in VALUES:
+                raise ValueError("Unknown value {" + value + "} in template " +
+                                 name + ": " + repr(layout))
+    elif isinstance(layout, dict):
+        for item in layout.values():
+            check_layout(name, item)
+    elif isinstance(layout, list):
+        for item in layout:
+            check_layout(name, item)
+
+
+def render_layout(layout, values):
+    """Layout with its placeholders replaced, in new dicts and lists"""
+    if isinstance(layout, str):
+        return layout.format_map(values)
+    if isinstance(layout, dict):
+        return {key: render_layout(item, values)
+                for key, item in layout.items()}
+    if isinstance(layout, list):
+        return [render_layout(item, values) for item in layout]
+    return layout
+
+
+class SlackTemplate(object):
+    """Message layout, checked once, rendered for each message"""
+    def __init__(self, name, layout):
+        check_layout(name, layout)
+        self.name       = name
+        self.layout     = layout
+
+    def render(self, values):
+        return render_layout(self.layout, values)
+
+
+class SlackTemplates(object):
+    """
+    Slack messages, checked once from `DEFAULT_TEMPLATES` and the
+    `slack.templates` configuration overriding them
+    """
+    def __init__(self, overrides=None):
+        layouts = dict(DEFAULT_TEMPLATES, **(overrides or {}))
+        self.templates = {name: SlackTemplate(name, layout)
+                          for name, layout in layouts.items()}
+
+    def render(self, name, values):
+        return self.templates[name].render(values)
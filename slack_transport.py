@@ -0,0 +1,158 @@
+from contextlib import contextmanager
+import heapq
+import itertools
+import threading
+import time
+
+import requests
+
+from log import log
+from resilience import resilience
+
+PRIORITY_HIGH   = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW    = 2
+
+# Requests per minute allowed by each Slack rate limit tier
+SLACK_TIERS = {1: 1, 2: 20, 3: 50, 4: 100}
+
+# Requests per minute for the methods we use, see
+# https://api.slack.com/docs/rate-limits
+# Limits of `PER_CHANNEL_METHODS` apply to each channel.
+SLACK_METHODS_LIMITS = {
+    'chat.postMessage':     60,
+    'channels.create':      SLACK_TIERS[2],
+    'channels.list':        SLACK_TIERS[2],
+    'channels.setPurpose':  SLACK_TIERS[2],
+    'channels.setTopic':    SLACK_TIERS[2],
+    'channels.info':        SLACK_TIERS[3],
+    'channels.join':        SLACK_TIERS[3],
+    'channels.invite':      SLACK_TIERS[3],
+    'users.info':           SLACK_TIERS[4],
+}
+DEFAULT_LIMIT = SLACK_TIERS[3]
+# Methods limited per channel rather than per workspace
+PER_CHANNEL_METHODS = ('chat.postMessage',)
+
+
+class TokenBucket(object):
+    """
+    Token bucket handing tokens out by priority, then by arrival order
+
+    `rate` is in tokens per second; up to `burst` tokens can be saved up.
+    """
+    def __init__(self, rate, burst):
+        self.rate           = rate
+        self.burst          = burst
+        self.tokens         = burst
+        self.last_refill    = time.monotonic()
+        self.paused_until   = 0
+        self.waiters        = []
+        self.counter        = itertools.count()
+        self.cond           = threading.Condition()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def acquire(self, priority=PRIORITY_NORMAL):
+        with self.cond:
+            ticket = (priority, next(self.counter))
+            heapq.heappush(self.waiters, ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if self.waiters[0] != ticket:
+                        # Someone more urgent, or older, goes first
+                        self.cond.wait()
+                    elif now < self.paused_until:
+                        self.cond.wait(self.paused_until - now)
+                    elif self.tokens < 1:
+                        self.cond.wait((1 - self.tokens) / self.rate)
+                    else:
+                        self.tokens -= 1
+                        return
+            finally:
+                self.waiters.remove(ticket)
+                heapq.heapify(self.waiters)
+                self.cond.notify_all()
+
+    def pause(self, seconds):
+        """Hold every token for `seconds`, when Slack told us to back off"""
+        with self.cond:
+            self.paused_until = max(self.paused_until,
+                                    time.monotonic() + seconds)
+            self.tokens = 0
+
+
+class SlackSession(requests.Session):
+    """
+    Session shared by the Slack clients, scheduling calls per method
+
+    Each Slack method gets its own token bucket following its rate limit
+    tier, and each channel its own for `PER_CHANNEL_METHODS`. Calls wait for a token (most urgent first, see `priority`) rather
+    than failing, and are retried after `Retry-After` when Slack still
+    answers with a 429.
+    """
+    def __init__(self, limits=None, max_retries=5):
+        super(SlackSession, self).__init__()
+        self.limits         = dict(SLACK_METHODS_LIMITS, **(limits or {}))
+        self.max_retries    = max_retries
+        self.buckets        = {}
+        self.buckets_lock   = threading.Lock()
+        self.local          = threading.local()
+
+    @contextmanager
+    def priority(self, priority):
+        """Priority of the Slack calls made by this thread in this block"""
+        previous = getattr(self.local, 'priority', PRIORITY_NORMAL)
+        self.local.priority = priority
+        try:
+            yield
+        finally:
+            self.local.priority = previous
+
+    def get_bucket(self, slack_method, channel=None):
+        key = slack_method
+        if slack_method in PER_CHANNEL_METHODS:
+            key = (slack_method, channel)
+        with self.buckets_lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                per_minute = self.limits.get(slack_method, DEFAULT_LIMIT)
+                bucket = TokenBucket(rate=per_minute / 60.0,
+                                     burst=max(1, per_minute // 10))
+                self.buckets[key] = bucket
+            return bucket
+
+    @staticmethod
+    def channel_of(kwargs):
+        """Channel a Slack call is about, from its form data or query"""
+        for name in ('data', 'params'):
+            values = kwargs.get(name)
+            if isinstance(values, dict) and 'channel' in values:
+                return values['channel']
+        return None
+
+    def request(self, method, url, *args, **kwargs):
+        slack_method = url.rsplit('/', 1)[-1]
+        bucket = self.get_bucket(slack_method, self.channel_of(kwargs))
+        priority = getattr(self.local, 'priority', PRIORITY_NORMAL)
+        retries = 0
+        while True:
+            # Waiting for our turn isn't calling Slack
+            with resilience.waiting('slack'):
+                bucket.acquire(priority)
+            response = super(SlackSession, self).request(method, url,
+                                                         *args, **kwargs)
+            if response.status_code != 429 or retries >= self.max_retries:
+                return response
+            retries += 1
+            retry_after = int(response.headers.get('Retry-After',
+                                                   2 ** retries))
+            log.warning("Rate limited by Slack on %s, retrying in %ss "
+                        "(%s/%s)", slack_method, retry_after, retries,
+                        self.max_retries)
+            bucket.pause(retry_after)
@@ -0,0 +1,87 @@
+import atexit
+import json
+import os
+import tempfile
+import threading
+import time
+
+from log import log
+import codec
+
+# Bumped whenever the content of snapshots changes
+FORMAT = 1
+
+
+class SnapshotFile(object):
+    """
+    Local state saved to `path` every `interval` seconds and at exit, so
+    that a restarted process starts with it instead of an empty state
+
+    `collect()` returns the state to save, as JSON-compatible values, or
+    None when there is nothing worth saving yet. Snapshots are written to a
+    temporary file of this process first, then moved over the previous one,
+    so neither a crash nor another process saving at the same time leaves a
+    partial snapshot behind.
+    """
+    def __init__(self, path, collect, interval=60.0):
+        self.path       = path
+        self.collect    = collect
+        self.interval   = interval
+        self.lock       = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self._run, name="snapshot",
+                         daemon=True).start()
+        atexit.register(self.save)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            # noinspection PyBroadException
+            try:
+                self.save()
+            except Exception:
+                log.exception("Couldn't save snapshot to %s", self.path)
+
+    def save(self):
+        # Anything written while collecting is caught up on after a restart
+        taken = time.time()
+        start = time.perf_counter()
+        state = self.collect()
+        if state is None:
+            return
+        with self.lock:
+            # A temporary file of our own: server workers may share the path
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(self.path)),
+                prefix=os.path.basename(self.path) + ".", suffix=".tmp")
+            try:
+                with os.fdopen(fd, 'w') as snapshot_file:
+                    snapshot_file.write(codec.dumps(
+                        dict(state, format=FORMAT, time=taken)))
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        log.debug("Saved snapshot to %s in %.3fs", self.path,
+                  time.perf_counter() - start)
+
+    def load(self):
+        """
+        Last saved state, with the `time` it was taken at, or None if there
+        is none
+        """
+        if not os.path.exists(self.path):
+            return None
+        log.info("Loading snapshot from %s ...", self.path)
+        try:
+            with open(self.path, 'r') as snapshot_file:
+                state = json.load(snapshot_file)
+        except (OSError, ValueError):
+            log.warning("Ignoring unreadable snapshot %s", self.path,
+                        exc_info=True)
+            return None
+        if state.get('format') != FORMAT:
+            log.warning("Ignoring snapshot %s of another format", self.path)
+            return None
+        return state
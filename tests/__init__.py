@@ -0,0 +1,35 @@
+"""
+Unit tests, run from the repository root with
+
+    python -m unittest discover -s tests -t .
+
+Modules read config.json from the working directory when imported: tests
+run from a temporary directory holding a minimal one, like the benchmarks.
+"""
+import json
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TEST_CONFIG = {
+    "slack": {
+        "channel": "#incidents",
+        "self": {"token": "xoxb-test", "id": "UBOT", "name": "incidents-bot"},
+        "fake_user": {"token": "xoxp-test"},
+        "apiai_user": {"id": "UAPIAI"}
+    },
+    "elasticsearch": {"index": "incidents", "host": "localhost",
+                      "region": "local"},
+    "jira": {"host": "https://jira.example.org", "user": "test",
+             "password": "test", "project": "INC"},
+    "cachet": {"host": "http://cachet.example.org/api/v1", "token": "test"},
+    "warmup": False
+}
+
+workdir = tempfile.mkdtemp(prefix='incidents-tests-')
+with open(os.path.join(workdir, 'config.json'), 'w') as config_file:
+    json.dump(TEST_CONFIG, config_file)
+os.chdir(workdir)
@@ -0,0 +1,82 @@
+import json
+import unittest
+from unittest import mock
+
+from elasticsearch import ConnectionError as EsConnectionError
+from elasticsearch.serializer import JSONSerializer
+
+import es_writer
+from es_writer import EsWriter
+from resilience import Resilience, CircuitState
+
+
+class FakeTransport(object):
+    serializer = JSONSerializer()
+
+
+class FakeElasticsearch(object):
+    transport = FakeTransport()
+
+    def __init__(self):
+        self.down       = False
+        self.requests   = []
+
+    def bulk(self, body, **params):
+        if self.down:
+            raise EsConnectionError('N/A', "Connection refused", None)
+        lines = [json.loads(line) for line in body.splitlines() if line]
+        self.requests.append(lines)
+        return {'errors': False,
+                'items': [{'update': {'_id': action['update']['_id'],
+                                      'status': 200}}
+                          for action in lines[::2]]}
+
+
+class EsWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.resilience = Resilience({'elasticsearch': {
+            'circuit_failures': 1,
+            'circuit_cooldown': 60
+        }})
+        patcher = mock.patch.object(es_writer, 'resilience', self.resilience)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.es = FakeElasticsearch()
+        self.writer = EsWriter(lambda: self.es, 'incidents')
+
+    def test_bulk_failure_requeued_and_counted(self):
+        self.es.down = True
+        self.writer.update(1, '{"state":"Closed"}')
+        self.writer.append(1, 'updates', '{"message":"Fixed"}')
+        with self.assertRaises(Exception):
+            self.writer.flush()
+        self.assertEqual(self.writer._pending(), 2)
+        self.assertEqual(self.resilience.breaker('elasticsearch').state,
+                         CircuitState.OPEN)
+
+    def test_open_circuit_keeps_writes(self):
+        self.resilience.breaker('elasticsearch').failure()
+        self.writer.update(1, '{"state":"Closed"}')
+        self.writer.update(2, '{"state":"Closed"}')
+        with self.assertRaises(Exception):
+            self.writer.flush()
+        self.assertEqual(self.writer._pending(), 2)
+        self.assertEqual(self.es.requests, [])
+
+    def test_requeued_writes_flushed_once_back(self):
+        self.es.down = True
+        self.writer.update(1, '{"state":"Closed"}')
+        with self.assertRaises(Exception):
+            self.writer.flush()
+        self.es.down = False
+        self.resilience.breaker('elasticsearch').success()
+        self.writer.update(1, '{"cachet_id":3}')
+        self.writer.flush()
+        self.assertEqual(self.writer._pending(), 0)
+        self.assertEqual(self.es.requests[0][1],
+                         {'doc': {'state': "Closed", 'cachet_id': 3},
+                          'doc_as_upsert': True})
+
+
+if __name__ == '__main__':
+    unittest.main()
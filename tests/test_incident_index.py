@@ -0,0 +1,26 @@
+import unittest
+from datetime import datetime, timezone
+
+from incident_index import parse_date
+
+
+class ParseDateTest(unittest.TestCase):
+    def test_local_date(self):
+        self.assertEqual(parse_date('2018-01-31T12:00:00'),
+                         datetime(2018, 1, 31, 12))
+
+    def test_date_with_offset_made_local(self):
+        date = parse_date('2018-01-31T12:00:00+00:00')
+        self.assertIsNone(date.tzinfo)
+        expected = datetime(2018, 1, 31, 12, tzinfo=timezone.utc)
+        self.assertEqual(date, expected.astimezone().replace(tzinfo=None))
+        # Comparable with the dates of the incidents
+        self.assertLess(date, datetime.now())
+
+    def test_invalid_date(self):
+        with self.assertRaises(ValueError):
+            parse_date('yesterday')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+import unittest
+
+from incident_store import IncidentStore
+
+NOW = datetime(2026, 1, 1, 12, 0, 0)
+
+
+def incident(updated_time, description="From Elasticsearch"):
+    return SimpleNamespace(slack_channel_id='C1', updated_time=updated_time,
+                           description=description)
+
+
+class IncidentStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.store = IncidentStore()
+
+    def test_loaded_when_missing(self):
+        self.assertTrue(self.store.put_if_newer(incident(NOW)))
+        self.assertEqual(self.store.get_by_channel('C1').updated_time, NOW)
+
+    def test_newer_write_kept(self):
+        # A command changed it after the scanned copy was written
+        self.store.put(incident(NOW + timedelta(seconds=1), "New"))
+        self.assertFalse(self.store.put_if_newer(incident(NOW)))
+        self.assertFalse(self.store.put_if_newer(incident(None)))
+        self.assertEqual(self.store.get_by_channel('C1').description, "New")
+
+    def test_older_copy_replaced(self):
+        self.store.put(incident(NOW, "Old"))
+        self.assertTrue(self.store.put_if_newer(
+            incident(NOW + timedelta(seconds=1))))
+        self.assertEqual(self.store.get_by_channel('C1').description,
+                         "From Elasticsearch")
+
+    def test_never_written_copy_replaced(self):
+        self.store.put(incident(None, "Old"))
+        self.assertTrue(self.store.put_if_newer(incident(None)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,29 @@
+import unittest
+
+from jobs import JobQueue, JobState
+
+
+class JobQueueTest(unittest.TestCase):
+    def setUp(self):
+        # Workers aren't started: jobs stay queued until run by hand
+        self.jobs = JobQueue(workers=1, history=3)
+
+    def test_pending_jobs_kept_beyond_history(self):
+        submitted = [self.jobs.submit("job", lambda: None) for _ in range(5)]
+        for job in submitted:
+            self.assertIs(self.jobs.get(job.id), job)
+
+    def test_oldest_finished_jobs_forgotten(self):
+        submitted = [self.jobs.submit("job", lambda: None) for _ in range(3)]
+        submitted[1].state = JobState.DONE
+        submitted[2].state = JobState.FAILED
+        newer = [self.jobs.submit("job", lambda: None) for _ in range(2)]
+        self.assertIs(self.jobs.get(submitted[0].id), submitted[0])
+        self.assertIsNone(self.jobs.get(submitted[1].id))
+        self.assertIsNone(self.jobs.get(submitted[2].id))
+        for job in newer:
+            self.assertIs(self.jobs.get(job.id), job)
+
+
+if __name__ == '__main__':
+    unittest.main()
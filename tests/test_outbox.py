@@ -0,0 +1,56 @@
+import os
+import tempfile
+import unittest
+
+from outbox import Outbox
+
+
+class OutboxTest(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'outbox.sqlite')
+        self.outbox = Outbox(self.path, backoff=60, max_backoff=60)
+        self.ran = []
+        self.failing = set()
+
+        def add_comment(payload):
+            if payload['body'] in self.failing:
+                raise Exception("Jira is having a bad day")
+            self.ran.append(payload['body'])
+        self.outbox.register('jira', 'add_comment', add_comment)
+
+    def enqueue(self, body, key):
+        self.outbox.enqueue('jira', 'add_comment', {'body': body}, key=key)
+
+    def run_all(self):
+        # Dispatchers aren't started: run what is due, one at a time
+        for _ in range(10):
+            self.outbox._run_next('jira')
+
+    def test_same_key_in_order(self):
+        self.enqueue("first", 'C1')
+        self.enqueue("second", 'C1')
+        self.run_all()
+        self.assertEqual(self.ran, ["first", "second"])
+
+    def test_failure_holds_back_its_key_only(self):
+        self.failing.add("first of C1")
+        self.enqueue("first of C1", 'C1')
+        self.enqueue("second of C1", 'C1')
+        self.enqueue("first of C2", 'C2')
+        self.enqueue("without key", None)
+        self.run_all()
+        self.assertEqual(self.ran, ["first of C2", "without key"])
+        self.assertEqual(self.outbox.stats()['jira']['pending'], 2)
+
+    def test_dead_entry_releases_its_key(self):
+        self.outbox.max_attempts = 1
+        self.failing.add("first")
+        self.enqueue("first", 'C1')
+        self.enqueue("second", 'C1')
+        self.run_all()
+        self.assertEqual(self.ran, ["second"])
+        self.assertEqual(self.outbox.stats()['jira']['dead'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+import contextvars
+import threading
+import time
+import unittest
+
+from resilience import Resilience, CircuitBreaker, CircuitState, \
+    CircuitOpenError, BulkheadFullError, PermanentError
+
+
+class BackendDown(Exception):
+    pass
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker('jira', failures=3, cooldown=0.05)
+
+    def test_opens_after_consecutive_failures(self):
+        for _ in range(2):
+            self.assertTrue(self.breaker.acquire())
+            self.breaker.failure()
+        self.assertEqual(self.breaker.state, CircuitState.CLOSED)
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, CircuitState.OPEN)
+        self.assertFalse(self.breaker.acquire())
+
+    def test_success_resets_failures(self):
+        self.breaker.failure()
+        self.breaker.failure()
+        self.breaker.success()
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, CircuitState.CLOSED)
+
+    def test_single_trial_after_cooldown(self):
+        for _ in range(3):
+            self.breaker.failure()
+        time.sleep(0.06)
+        self.assertTrue(self.breaker.acquire())
+        self.assertEqual(self.breaker.state, CircuitState.HALF_OPEN)
+        self.assertFalse(self.breaker.acquire())
+        self.breaker.success()
+        self.assertEqual(self.breaker.state, CircuitState.CLOSED)
+        self.assertTrue(self.breaker.acquire())
+
+    def test_failed_trial_reopens(self):
+        for _ in range(3):
+            self.breaker.failure()
+        time.sleep(0.06)
+        self.assertTrue(self.breaker.acquire())
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, CircuitState.OPEN)
+        self.assertFalse(self.breaker.acquire())
+
+
+class GuardTest(unittest.TestCase):
+    def setUp(self):
+        self.resilience = Resilience({'default': {
+            'circuit_failures': 2,
+            'circuit_cooldown': 0.05,
+            'max_concurrent': 1,
+            'max_wait': 0.05
+        }})
+
+    def call_failing(self, backend, error):
+        with self.assertRaises(type(error)):
+            with self.resilience.guard(backend, 'call'):
+                raise error
+
+    def test_backend_failures_open_circuit(self):
+        self.call_failing('jira', BackendDown())
+        self.call_failing('jira', BackendDown())
+        with self.assertRaises(CircuitOpenError):
+            with self.resilience.guard('jira', 'call'):
+                self.fail("Backend called with an open circuit")
+
+    def test_request_errors_dont_count(self):
+        for _ in range(3):
+            self.call_failing('jira', PermanentError("Bad request"))
+        self.assertEqual(self.resilience.breaker('jira').state,
+                         CircuitState.CLOSED)
+
+    def test_nested_guard_takes_neither_trial_nor_slot(self):
+        # Connecting on first use runs within the guard of the call
+        for _ in range(2):
+            self.call_failing('jira', BackendDown())
+        time.sleep(0.06)
+        with self.resilience.guard('jira', 'create_issue'):
+            with self.resilience.guard('jira', 'connect'):
+                pass
+        breaker = self.resilience.breaker('jira')
+        self.assertEqual(breaker.state, CircuitState.CLOSED)
+        self.assertEqual(breaker.failed, 0)
+        self.assertEqual(self.resilience.bulkhead('jira').in_flight, 0)
+
+    def test_nested_failure_counted_once(self):
+        with self.assertRaises(BackendDown):
+            with self.resilience.guard('jira', 'create_issue'):
+                with self.resilience.guard('jira', 'connect'):
+                    raise BackendDown()
+        self.assertEqual(self.resilience.breaker('jira').failed, 1)
+
+    def test_guards_not_shared_across_threads(self):
+        # Plans run their steps in copies of the caller's context
+        errors = []
+
+        def call():
+            try:
+                with self.resilience.guard('slack', 'call'):
+                    pass
+            except BulkheadFullError as e:
+                errors.append(e)
+        with self.resilience.guard('slack', 'call'):
+            thread = threading.Thread(target=contextvars.copy_context().run,
+                                      args=(call,))
+            thread.start()
+            thread.join()
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(self.resilience.bulkhead('slack').in_flight, 0)
+
+    def test_waiting_releases_slot(self):
+        entered = threading.Event()
+        release = threading.Event()
+
+        def wait_for_turn():
+            with self.resilience.guard('slack', 'call'):
+                with self.resilience.waiting('slack'):
+                    entered.set()
+                    release.wait()
+        thread = threading.Thread(target=wait_for_turn)
+        thread.start()
+        entered.wait()
+        try:
+            # The slot is free while the other call waits
+            with self.resilience.guard('slack', 'call'):
+                pass
+        finally:
+            release.set()
+            thread.join()
+        bulkhead = self.resilience.bulkhead('slack')
+        self.assertEqual(bulkhead.in_flight, 0)
+        self.assertEqual(bulkhead.rejected, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+import unittest
+
+from slack_templates import SlackTemplates, VALUES
+
+
+class SlackTemplatesTest(unittest.TestCase):
+    def setUp(self):
+        self.values = {name: name.upper() for name in VALUES}
+
+    def test_renders_placeholders(self):
+        templates = SlackTemplates({'close_confirmation': {
+            'text': "Incident {id} closed, see {jira_link}"
+        }})
+        self.assertEqual(templates.render('close_confirmation', self.values),
+                         {'text': "Incident ID closed, see JIRA_LINK"})
+
+    def test_unknown_value_refused(self):
+        with self.assertRaises(ValueError):
+            SlackTemplates({'summary': {'text': "{owner} is on it"}})
+
+    def test_messages_not_shared(self):
+        templates = SlackTemplates()
+        message = templates.render('summary', self.values)
+        message['attachments'][0]['mrkdwn_in'].append('fields')
+        message['attachments'].append({'text': "More"})
+        self.assertEqual(templates.render('summary', self.values),
+                         SlackTemplates().render('summary', self.values))
+        self.assertEqual(
+            len(templates.render('summary', self.values)['attachments']), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import time
+import unittest
+from unittest import mock
+
+import requests
+
+from slack_transport import SlackSession
+
+API_URL = "https://slack.com/api/"
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, headers=None):
+        self.status_code    = status_code
+        self.headers        = headers or {}
+
+
+class SlackSessionTest(unittest.TestCase):
+    def setUp(self):
+        self.responses = []
+        self.calls = []
+
+        def request(session, method, url, *args, **kwargs):
+            self.calls.append((url.rsplit('/', 1)[-1], kwargs))
+            if self.responses:
+                return self.responses.pop(0)
+            return FakeResponse(200)
+        patcher = mock.patch.object(requests.Session, 'request', request)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # One message every 10 seconds, no burst
+        self.session = SlackSession(limits={'chat.postMessage': 6})
+
+    def post_message(self, channel):
+        return self.session.request('post', API_URL + 'chat.postMessage',
+                                    data={'channel': channel, 'text': "Hi"})
+
+    def test_messages_limited_per_channel(self):
+        start = time.monotonic()
+        for channel in ('C1', 'C2', 'C3'):
+            self.post_message(channel)
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(len(self.calls), 3)
+        self.assertIsNot(self.session.get_bucket('chat.postMessage', 'C1'),
+                         self.session.get_bucket('chat.postMessage', 'C2'))
+
+    def test_message_waits_for_its_channel(self):
+        self.post_message('C1')
+        bucket = self.session.get_bucket('chat.postMessage', 'C1')
+        self.assertLess(bucket.tokens, 1)
+
+    def test_other_methods_limited_per_method(self):
+        self.assertIs(self.session.get_bucket('channels.info', 'C1'),
+                      self.session.get_bucket('channels.info', 'C2'))
+
+    def test_channel_of_call(self):
+        self.assertEqual(SlackSession.channel_of({'data': {'channel': 'C1'}}),
+                         'C1')
+        self.assertEqual(
+            SlackSession.channel_of({'params': {'channel': 'C2'}}), 'C2')
+        self.assertIsNone(SlackSession.channel_of({'params': {'user': 'U1'}}))
+
+    def test_rate_limited_call_retried(self):
+        self.session.limits['users.info'] = 600
+        self.responses = [FakeResponse(429, {'Retry-After': '0'})]
+        response = self.session.request('get', API_URL + 'users.info',
+                                        params={'user': 'U1'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_rate_limited_call_given_up(self):
+        self.session.max_retries = 1
+        self.session.limits['users.info'] = 600
+        self.responses = [FakeResponse(429, {'Retry-After': '0'}),
+                          FakeResponse(429, {'Retry-After': '0'})]
+        response = self.session.request('get', API_URL + 'users.info',
+                                        params={'user': 'U1'})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(len(self.calls), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import os
+import tempfile
+import threading
+import unittest
+
+from snapshot import SnapshotFile
+
+
+class SnapshotFileTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'snapshot.json')
+
+    def test_saved_then_loaded(self):
+        SnapshotFile(self.path, lambda: {'index': [1, 2]}).save()
+        state = SnapshotFile(self.path, None).load()
+        self.assertEqual(state['index'], [1, 2])
+        self.assertIn('time', state)
+
+    def test_nothing_saved_until_collected(self):
+        SnapshotFile(self.path, lambda: None).save()
+        self.assertIsNone(SnapshotFile(self.path, None).load())
+
+    def test_unreadable_snapshot_ignored(self):
+        with open(self.path, 'w') as snapshot_file:
+            snapshot_file.write('{"index": [1,')
+        self.assertIsNone(SnapshotFile(self.path, None).load())
+
+    def test_processes_saving_together(self):
+        # Server workers save to the same path, each with its own state
+        big = list(range(100000))
+        snapshots = [SnapshotFile(self.path, lambda n=n: {'worker': n,
+                                                          'index': big})
+                     for n in range(4)]
+
+        errors = []
+
+        def save(snapshot):
+            try:
+                for _ in range(5):
+                    snapshot.save()
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=save, args=(snapshot,))
+                   for snapshot in snapshots]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        state = SnapshotFile(self.path, None).load()
+        self.assertEqual(state['index'], big)
+        self.assertEqual(os.listdir(self.dir), ['snapshot.json'])
+
+
+if __name__ == '__main__':
+    unittest.main()
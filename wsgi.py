@@ -0,0 +1,4 @@
+from app import app
+
+# WSGI entry point, served by gunicorn as wsgi:app
+application = app